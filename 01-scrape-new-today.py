@@ -1,5 +1,16 @@
+from argparse import ArgumentParser
 from configparser import ConfigParser
 import viewpoint as vp
+from pool import ViewpointPool
+from urlstore import UrlStore
+from ingest import Ingestor
+from checkpoint import Checkpoint
+from supervisor import SupervisedSession
+from tabs import TabEngine
+from archive import HtmlArchive
+from retries import RetryQueue, InterleavedRetries
+from metrics import Metrics
+import logging
 
 # Read credentials from config file
 config = ConfigParser()
@@ -13,34 +24,106 @@ username = YOUR_email@domain.com
 password = hunter2
 '''
 
-# Find the next available filename
-path = vp.next_filename("data/listings_")
+# --workers N scrapes with a pool of N browser sessions instead of just one
+# --max-rate caps the combined requests per minute across all of the sessions
+parser = ArgumentParser()
+parser.add_argument('--workers', type=int, default=0)
+parser.add_argument('--max-rate', type=float, default=None)
+# Listings that were scraped successfully are skipped, unless it's been more than --revisit-days since
+parser.add_argument('--revisit-days', type=float, default=None)
+# --ingest writes each listing into data/listings.db as soon as it's scraped
+parser.add_argument('--ingest', action='store_true')
+# --resume picks up an interrupted crawl from logs/checkpoint.json, see checkpoint.py
+parser.add_argument('--resume', action='store_true')
+# --recycle-after N restarts the browser every N listings, or once Chrome is using more than --max-rss MB
+parser.add_argument('--recycle-after', type=int, default=0)
+parser.add_argument('--max-rss', type=float, default=1500)
+# --tabs K scrapes K listings at a time in tabs of a single browser, see tabs.py
+parser.add_argument('--tabs', type=int, default=0)
+# --incremental stops at the first page that only has listings from earlier crawls, so it's cheap to run often
+parser.add_argument('--incremental', action='store_true')
+# --archive keeps the raw HTML of every cutsheet in data/archive, so it can be re-parsed with archive.py
+parser.add_argument('--archive', action='store_true')
+# --retry-batch N retries up to N earlier failures that are due every 20 listings (or every page with
+# --workers or --tabs), instead of leaving them all to 02-retry-failures.py
+parser.add_argument('--retry-batch', type=int, default=0)
+# --fetch-profile full downloads everything on each page like a normal browser, instead of skipping the
+# images, fonts, media and third-party scripts that aren't scraped, see viewpoint.FETCH_PROFILES
+parser.add_argument('--fetch-profile', default='lean', choices=list(vp.FETCH_PROFILES))
+args = parser.parse_args()
 
-# Log into ViewPoint
-session = vp.Viewpoint(
+# Find the next available filename, or keep using the one from the crawl we're resuming
+checkpoint = Checkpoint.load() if args.resume else None
+if checkpoint is None:
+    checkpoint = Checkpoint(search='Everything WithinDay', out_path=vp.next_filename("data/listings_"))
+path = checkpoint.out_path
+
+# The URLs that have been scraped before, shared with 02-retry-failures.py
+urls = UrlStore(revisit_after=args.revisit_days)
+ingest = Ingestor() if args.ingest else None
+incremental = checkpoint.search if args.incremental else None
+archive = HtmlArchive() if args.archive else None
+# Failures go on the retry queue in data/retries.db, which 02-retry-failures.py drains
+retries = RetryQueue()
+interleaved = InterleavedRetries(retries, batch=args.retry_batch) if args.retry_batch > 0 else None
+
+session_args = dict(
     username=config['credentials']['username'],
     password=config['credentials']['password'],
-    headless=True
+    headless=True,
+    out_path=path,
+    url_store=urls,
+    ingest=ingest,
+    archive=archive,
+    retries=retries,
+    fetch_profile=args.fetch_profile
 )
 
-# Open the Dashboard for a text list
-session.logger.debug('Opening the dashboard')
-session.explicitly_wait(2)
-session.find_element_by_link_text('DASHBOARD').click()
-session.explicitly_wait(5)
+if args.workers > 0:
+    # Log in a coordinator and a pool of workers
+    pool = ViewpointPool(workers=args.workers, max_rate=args.max_rate, retry_batch=args.retry_batch,
+                         **session_args)
+    pool.coordinator.open_saved_search(checkpoint.search)
+    if args.resume:
+        pool.coordinator.resume(checkpoint)
+    pool.scrape_index(checkpoint=checkpoint, incremental=incremental)
+    pool.quit()
+    checkpoint.finish()
+elif args.recycle_after > 0:
+    # Log in with a browser that's restarted every so often, it opens the search and resumes on its own
+    supervised = SupervisedSession(search=checkpoint.search, checkpoint=checkpoint,
+                                   max_listings=args.recycle_after, max_rss_mb=args.max_rss, **session_args)
+    supervised.scrape_index(incremental=incremental, after_listing=interleaved)
+    supervised.quit()
+else:
+    # Log into ViewPoint
+    session = vp.Viewpoint(**session_args)
 
-# Click on the 'Saved Searches' link
-session.logger.debug('Opening saved searches')
-session.find_element_by_link_text('SAVED SEARCHES').click()
-session.explicitly_wait(5)
+    # Open the previously saved 'Halifax in the Last Week' search
+    session.open_saved_search(checkpoint.search)
+    if args.resume:
+        session.resume(checkpoint)
 
-# Open the previously saved 'Halifax in the Last Week' search
-session.find_element_by_partial_link_text('Everything WithinDay').click()
-session.implicitly_wait(3)
+    # Scrape all of the lines
+    if args.tabs > 0:
+        TabEngine(session, tabs=args.tabs, retry_batch=args.retry_batch).scrape_index(
+            checkpoint=checkpoint, incremental=incremental)
+    else:
+        session.scrape_index(checkpoint=checkpoint, incremental=incremental, after_listing=interleaved)
+    session.quit()
+    checkpoint.finish()
 
-# Scrape all of the lines
-session.scrape_index()
+# The crawl made it to the end (or caught up), so the next incremental crawl can stop where this one started
+if incremental:
+    urls.finish_crawl(incremental)
 
 # Close everything at the end
-session.quit()
-session.logger.debug('Scrape complete')
+if ingest:
+    ingest.close()
+if archive:
+    archive.close()
+retries.close()
+# Per-stage timings and failure counts end up in logs/metrics.json, see metrics.py
+metrics = Metrics.shared()
+metrics.export()
+logging.getLogger('viewpointer').info('Scrape complete: ' + metrics.summary())
@@ -1,7 +1,6 @@
 from configparser import ConfigParser
 import viewpoint as vp
-from datetime import datetime, timedelta
-import os
+from retries import RetryQueue, drain
 
 # Read credentials from config file
 config = ConfigParser()
@@ -10,47 +9,31 @@ config.read('config.txt')
 # Find the next available filename
 path = vp.next_filename("data/listings_")
 
+# Failures from every earlier crawl wait on the retry queue in data/retries.db, see retries.py
+retries = RetryQueue()
+
 # Log into ViewPoint
 session = vp.Viewpoint(
     username=config['credentials']['username'],
     password=config['credentials']['password'],
-    headless=True
+    headless=True,
+    out_path=path,
+    direct_fetch=True,  # Retry cutsheets over plain HTTP, the browser is only needed for the pretty pages
+    retries=retries,
+    fetch_profile='lean'  # Only download what gets scraped, see viewpoint.FETCH_PROFILES
 )
 
-session.explicitly_wait(5)
-
-session.logger.info('Starting yesterday\'s failures')
-# Get the failed URLs from yesterday
-yesterday = datetime.now() - timedelta(days=1)
-failed_path = 'logs/failed/{dt}.log'.format(dt=yesterday.strftime('%Y%m%d'))
-urls = list()
-
-# Read the file in, if it exists
-try:
-    with open(failed_path, 'r') as log:
-        for line in log:
-            urls.append(line)
-except FileNotFoundError:
-    session.logger.info("No failures found in path: {0}".format(failed_path))
-
-# Scrape each of the URLs from the list of failures
-# If there are URLs in it, try each one
-if len(urls) > 0:
-    session.scrape_urls(urls)
-    session.logger.info("Finished with yesterday's failures")
-    # If the '.done'. file exists, append the URLS to the end
-    # Then
-    try:
-        with open(failed_path + ".done", 'a') as log:
-            for url in urls:
-                log.write(url)
-        os.remove(failed_path)
-        session.logger.info("Writing to {0}.done".format(failed_path))
-    # If the file doesn't
-    except FileNotFoundError:
-        os.rename(failed_path, failed_path + ".done")
-        session.logger.info("Renaming: {0} >> {0}.done".format(failed_path))
+# Pick up any failure logs from before there was a queue, or from days this script didn't run
+imported = retries.import_logs('logs/failed')
+if imported:
+    session.logger.info('Queued {n} failures from old logs'.format(n=imported))
 
+# Try everything that's due, highest priority first. Anything that fails again goes back on the
+# queue with a longer wait, until it runs out of attempts
+session.logger.info('Retrying {n} failures that are due'.format(n=retries.due_count()))
+worked = drain(session, retries)
+session.logger.info('Finished retrying, {n} worked and {m} are still waiting'.format(n=worked, m=len(retries)))
 
 # Close everything at the end
 session.quit()
+retries.close()
@@ -0,0 +1,198 @@
+from datetime import date, datetime, timedelta, timezone
+import logging
+import sqlite3
+import time
+
+# Everything the report reads instead of recomputing it from 'updates' and 'properties' on every render
+# agg_events holds one row per distinct (prop_id, status, price), like distinct() on 'listings' in the report,
+# and agg_last_price each pid's latest event, so the next run can work out price changes from it
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS agg_state (
+    name TEXT PRIMARY KEY, value INTEGER
+);
+CREATE TABLE IF NOT EXISTS agg_events (
+    prop_id INTEGER NOT NULL, status TEXT NOT NULL, price_key INTEGER NOT NULL, price INTEGER, datetime TEXT,
+    PRIMARY KEY (prop_id, status, price_key)
+);
+CREATE TABLE IF NOT EXISTS agg_daily_status (
+    date TEXT, status TEXT, n INTEGER,
+    PRIMARY KEY (date, status)
+);
+CREATE TABLE IF NOT EXISTS agg_weekly_price (
+    week TEXT, loc_bin TEXT, type TEXT, status TEXT,
+    n INTEGER, price_sum REAL, price_min INTEGER, price_max INTEGER, sqft_n INTEGER, price_per_sqft_sum REAL,
+    PRIMARY KEY (week, loc_bin, type, status)
+);
+CREATE TABLE IF NOT EXISTS agg_days_to_sale (
+    week TEXT, loc_bin TEXT, days INTEGER, n INTEGER,
+    PRIMARY KEY (week, loc_bin, days)
+);
+CREATE TABLE IF NOT EXISTS agg_last_price (
+    pid INTEGER PRIMARY KEY, price INTEGER, datetime TEXT
+);
+CREATE TABLE IF NOT EXISTS agg_price_changes (
+    pid INTEGER, prop_id INTEGER, datetime TEXT, status TEXT, loc_bin TEXT, price INTEGER, price_change REAL
+);
+CREATE INDEX IF NOT EXISTS agg_price_changes_datetime ON agg_price_changes (datetime);
+'''
+
+_TABLES = ['agg_events', 'agg_daily_status', 'agg_weekly_price', 'agg_days_to_sale', 'agg_last_price',
+           'agg_price_changes']
+
+# The updates between two rowids, only the listings the report looks at: in HRM, with a type and a status
+_BETWEEN = '''
+FROM updates u JOIN properties p ON p.prop_id = u.prop_id
+WHERE u.rowid > ? AND u.rowid <= ? AND u.status IS NOT NULL AND p.type IS NOT NULL
+  AND p.loc_bin IS NOT NULL AND p.loc_bin != 'Rest of Province'
+'''
+
+# The updates since the last run with what the aggregates need from their property, oldest first
+_NEW_UPDATES = '''
+SELECT u.rowid, u.prop_id, u.datetime, u.status, u.price, p.pid, p.loc_bin, p.type, p.sqft_mla, p.list_date
+''' + _BETWEEN + 'ORDER BY u.datetime, u.rowid'
+
+# Whether any of the updates since the last run is older than the newest one already added
+_BACKFILLED = 'SELECT 1 ' + _BETWEEN + 'AND u.datetime < (SELECT MAX(datetime) FROM agg_events) LIMIT 1'
+
+
+# The date part of a datetime from the DB, which is text from Python and may be seconds since 1970 from R
+def _day(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, timezone.utc).date()
+    return date.fromisoformat(str(value)[:10])
+
+
+# The Monday starting the week of 'day', like tsibble::yearweek() in the report
+def _week(day):
+    return day - timedelta(days=day.weekday())
+
+
+'''
+Keeps aggregate tables in the listings DB up to date for real-estate.Rmd, so it doesn't have to read
+and summarize the whole history of 'updates' on every render
+  * agg_daily_status   distinct listing events per day and status, i.e. new listings and sales
+  * agg_weekly_price   price (and price per square foot) by week, location bin, type and status
+  * agg_days_to_sale   how many days sold listings took to sell, by week and location bin
+  * agg_price_changes  every change in a property's price from its previous event
+Each run only reads the rows added to 'updates' since the last one, which is remembered in agg_state
+by rowid ('updates' is only ever appended to). Price changes and first sightings depend on the order
+things happened in, so if it looks like 'updates' was rebuilt, or the new rows go back further than ones
+already added (e.g. from replaying archived pages), everything here is rebuilt
+'''
+class Aggregator:
+    def __init__(self, db, batch_size=5000):
+        self.logger = logging.getLogger('viewpointer')
+        self.db = db
+        self.batch_size = batch_size
+        self.db.executescript(_SCHEMA)
+        self.db.commit()
+
+    def _state(self, name, default=0):
+        row = self.db.execute('SELECT value FROM agg_state WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else default
+
+    # Drop everything so the next update() starts from the first row of 'updates'
+    def reset(self):
+        with self.db:
+            for table in _TABLES:
+                self.db.execute('DELETE FROM ' + table)
+            self.db.execute('DELETE FROM agg_state')
+
+    # Fold the new rows of 'updates' into the aggregates. Returns the number of rows that were read
+    def update(self):
+        last = self._state('updates_rowid')
+        newest = self.db.execute('SELECT MAX(rowid) FROM updates').fetchone()[0] or 0
+        if newest < last:
+            self.logger.warning('The updates table is smaller than last time, rebuilding the aggregates')
+            self.reset()
+            last = 0
+        if newest == last:
+            return 0
+        if last and self.db.execute(_BACKFILLED, (last, newest)).fetchone():
+            self.logger.info('Some of the new updates are older than ones already added, rebuilding the aggregates')
+            self.reset()
+            last = 0
+
+        read = 0
+        cursor = self.db.execute(_NEW_UPDATES, (last, newest))
+        with self.db:
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    self._add(*row)
+                read += len(rows)
+            self.db.execute('INSERT OR REPLACE INTO agg_state (name, value) VALUES (?, ?)', ('updates_rowid', newest))
+            self.db.execute('INSERT OR REPLACE INTO agg_state (name, value) VALUES (?, ?)',
+                            ('updated', int(time.time())))
+        return read
+
+    # Add one update to the aggregates, if it's a new event for its property
+    def _add(self, rowid, prop_id, scraped, status, price, pid, loc_bin, type_, sqft_mla, list_date):
+        new = self.db.execute(
+            'INSERT OR IGNORE INTO agg_events (prop_id, status, price_key, price, datetime) VALUES (?, ?, ?, ?, ?)',
+            (prop_id, status, -1 if price is None else price, price, scraped)).rowcount
+        if not new:
+            return
+        day = _day(scraped)
+        week = str(_week(day))
+
+        self.db.execute('INSERT INTO agg_daily_status (date, status, n) VALUES (?, ?, 1) '
+                        'ON CONFLICT (date, status) DO UPDATE SET n = n + 1', (str(day), status))
+
+        if price is not None:
+            per_sqft = price / sqft_mla if sqft_mla else None
+            per_sqft = per_sqft if per_sqft is not None and 1 <= per_sqft <= 1000 else None
+            self.db.execute('''
+                INSERT INTO agg_weekly_price (week, loc_bin, type, status, n, price_sum, price_min, price_max,
+                                              sqft_n, price_per_sqft_sum)
+                VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?, ?)
+                ON CONFLICT (week, loc_bin, type, status) DO UPDATE SET
+                    n = n + 1,
+                    price_sum = price_sum + excluded.price_sum,
+                    price_min = MIN(price_min, excluded.price_min),
+                    price_max = MAX(price_max, excluded.price_max),
+                    sqft_n = sqft_n + excluded.sqft_n,
+                    price_per_sqft_sum = price_per_sqft_sum + excluded.price_per_sqft_sum
+                ''', (week, loc_bin, type_, status, price, price, price,
+                      0 if per_sqft is None else 1, per_sqft or 0))
+
+        # Same listings as the 'Time on Market' figure, sales between $100k and $1M
+        listed = _day(list_date)
+        if status == 'Sold' and listed is not None and price is not None and 1e5 <= price <= 1e6:
+            self.db.execute('INSERT INTO agg_days_to_sale (week, loc_bin, days, n) VALUES (?, ?, ?, 1) '
+                            'ON CONFLICT (week, loc_bin, days) DO UPDATE SET n = n + 1',
+                            (week, loc_bin, max((day - listed).days, 1)))
+
+        if pid is None or price is None:
+            return
+        previous = self.db.execute('SELECT price FROM agg_last_price WHERE pid = ?', (pid,)).fetchone()
+        if previous and previous[0]:
+            self.db.execute('INSERT INTO agg_price_changes (pid, prop_id, datetime, status, loc_bin, price, '
+                            'price_change) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (pid, prop_id, scraped, status, loc_bin, price, (price - previous[0]) / previous[0]))
+        self.db.execute('INSERT OR REPLACE INTO agg_last_price (pid, price, datetime) VALUES (?, ?, ?)',
+                        (pid, price, scraped))
+
+
+# Bring the aggregates in the listings DB up to date, e.g. `python aggregates.py` before rendering the report
+# --rebuild starts them over from the first row of 'updates'
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--db', default='data/listings.db')
+    parser.add_argument('--rebuild', action='store_true')
+    args = parser.parse_args()
+
+    listings = sqlite3.connect(args.db)
+    aggregator = Aggregator(listings)
+    if args.rebuild:
+        aggregator.reset()
+    start = time.perf_counter()
+    n = aggregator.update()
+    print('Added {n} updates to the aggregates in {t:.1f} secs'.format(n=n, t=time.perf_counter() - start))
+    listings.close()
@@ -0,0 +1,196 @@
+from datetime import datetime
+import gzip
+import hashlib
+import logging
+from multiprocessing import Pool
+import os
+import sqlite3
+import threading
+from cutsheet import parse_cutsheet, is_valid, to_record
+from writer import RecordWriter, next_filename
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pages (
+    hash TEXT PRIMARY KEY, segment TEXT, offset INTEGER, length INTEGER, size INTEGER
+);
+CREATE TABLE IF NOT EXISTS fetches (
+    url TEXT, datetime TEXT, hash TEXT
+);
+CREATE INDEX IF NOT EXISTS fetches_url ON fetches (url, datetime);
+CREATE INDEX IF NOT EXISTS fetches_datetime ON fetches (datetime);
+'''
+
+
+'''
+Keeps the raw HTML of every cutsheet that's fetched, so it can be parsed again later without re-scraping
+Pages are stored once per distinct content, keyed by their SHA-256, as gzip members appended to
+segment files of up to 'segment_mb' MB in the 'path' directory. Each member can be read on its own,
+and a whole segment is also a valid .gz file. index.db records where each page is (pages) and
+every time a URL was fetched and what it looked like (fetches), so an unchanged re-listing costs one row
+'''
+class HtmlArchive:
+    def __init__(self, path='data/archive', segment_mb=64, commit_every=50):
+        self.logger = logging.getLogger('viewpointer')
+        self.path = path
+        self.segment_bytes = segment_mb * 1024 ** 2
+        self.commit_every = commit_every
+        self._pending = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+        self.db = sqlite3.connect(os.path.join(path, 'index.db'), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(_SCHEMA)
+        self.db.commit()
+
+        # Keep appending to the newest segment
+        last = self.db.execute('SELECT MAX(segment) FROM pages').fetchone()[0]
+        self.segment = last or 'segment-00000.gz'
+        self._file = None
+
+    # Archive the HTML of 'url' fetched at 'fetched' (a str like str(datetime.now()), defaults to now)
+    # Returns the page's hash
+    def add(self, html, url, fetched=None):
+        data = html.encode('utf-8') if isinstance(html, str) else html
+        digest = hashlib.sha256(data).hexdigest()
+        fetched = fetched or str(datetime.now())
+        with self._lock:
+            known = self.db.execute('SELECT 1 FROM pages WHERE hash = ?', (digest,)).fetchone()
+            if not known:
+                offset, length = self._append(gzip.compress(data, compresslevel=6))
+                self.db.execute('INSERT INTO pages (hash, segment, offset, length, size) VALUES (?, ?, ?, ?, ?)',
+                                (digest, self.segment, offset, length, len(data)))
+            self.db.execute('INSERT INTO fetches (url, datetime, hash) VALUES (?, ?, ?)', (url, fetched, digest))
+            self._pending += 1
+            if self._pending >= self.commit_every:
+                self._commit()
+        return digest
+
+    # Append compressed bytes to the current segment, starting a new one once it's full
+    def _append(self, blob):
+        if self._file is None:
+            self._file = open(os.path.join(self.path, self.segment), 'ab')
+        offset = self._file.seek(0, os.SEEK_END)
+        if offset and offset + len(blob) > self.segment_bytes:
+            self._file.close()
+            number = int(self.segment.split('-')[1].split('.')[0]) + 1
+            self.segment = 'segment-{0:05d}.gz'.format(number)
+            self._file = open(os.path.join(self.path, self.segment), 'ab')
+            offset = 0
+        self._file.write(blob)
+        return offset, len(blob)
+
+    # Make sure the pages are on disk before the index points at them
+    def _commit(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self.db.commit()
+        self._pending = 0
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+
+    # The HTML of the page with the hash 'digest' as bytes, or None if it isn't archived
+    def get(self, digest):
+        with self._lock:
+            self._commit()  # It may have been added since the segment was last flushed
+            found = self.db.execute('SELECT segment, offset, length FROM pages WHERE hash = ?', (digest,)).fetchone()
+        if not found:
+            return None
+        segment, offset, length = found
+        with open(os.path.join(self.path, segment), 'rb') as file:
+            file.seek(offset)
+            return gzip.decompress(file.read(length))
+
+    # Every time 'url' was fetched, as (datetime, hash) from oldest to newest
+    def lookup(self, url):
+        with self._lock:
+            return self.db.execute('SELECT datetime, hash FROM fetches WHERE url = ? ORDER BY datetime',
+                                   (url,)).fetchall()
+
+    # Yield (url, datetime, html) for every fetch from 'since' up to (not including) 'until', both str dates
+    # Pages are read segment by segment in the order they were written, so it's one pass over the files
+    def replay(self, since=None, until=None):
+        query = 'SELECT f.url, f.datetime, p.segment, p.offset, p.length FROM fetches f ' \
+                'JOIN pages p ON p.hash = f.hash WHERE f.datetime >= ? AND f.datetime < ? ' \
+                'ORDER BY p.segment, p.offset'
+        with self._lock:
+            self._commit()
+            rows = self.db.execute(query, (since or '', until or '9999')).fetchall()
+        files = dict()
+        try:
+            for url, fetched, segment, offset, length in rows:
+                if segment not in files:
+                    files[segment] = open(os.path.join(self.path, segment), 'rb')
+                file = files[segment]
+                file.seek(offset)
+                yield url, fetched, gzip.decompress(file.read(length))
+        finally:
+            for file in files.values():
+                file.close()
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self.db.close()
+
+
+# Parse one archived page back into a record, see replay_listings() below
+def _parse(page):
+    url, fetched, html = page
+    listing = parse_cutsheet(html)
+    return to_record(listing, url, fetched) if is_valid(listing) else None
+
+
+# Parse every archived page back into listings, on 'jobs' processes, writing them to 'out'
+# The records have the time the page was originally fetched, so they match what was scraped at the time
+def replay_listings(archive, out, since=None, until=None, jobs=None, ingest=None):
+    written = skipped = 0
+    writer = RecordWriter.open(out)
+    with Pool(jobs) as pool:
+        for record in pool.imap(_parse, archive.replay(since, until), chunksize=32):
+            if record is None:
+                skipped += 1
+                continue
+            writer.write(record)
+            if ingest is not None:
+                ingest.add(record, source_file=out)
+            written += 1
+    writer.flush()
+    return written, skipped
+
+
+# Re-parse archived cutsheets into a new listings file, e.g. after fixing the parser
+# `python archive.py --since 2020-06-01 [--out data/listings_202007010.jsonl] [--ingest] [--jobs 4]`
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    import time
+
+    parser = ArgumentParser()
+    parser.add_argument('--path', default='data/archive')
+    parser.add_argument('--since', default=None)
+    parser.add_argument('--until', default=None)
+    parser.add_argument('--out', default=None)
+    parser.add_argument('--jobs', type=int, default=None)
+    parser.add_argument('--ingest', action='store_true')
+    args = parser.parse_args()
+
+    archive = HtmlArchive(args.path)
+    out = args.out or next_filename('data/listings_')
+    ingest = None
+    if args.ingest:
+        from ingest import Ingestor
+        ingest = Ingestor()
+
+    start = time.perf_counter()
+    written, skipped = replay_listings(archive, out, args.since, args.until, args.jobs, ingest)
+    if ingest is not None:
+        ingest.close()
+    archive.close()
+    print('Replayed {n} listings into {out} ({s} invalid pages skipped) in {t:.1f} secs'.format(
+        n=written, out=out, s=skipped, t=time.perf_counter() - start))
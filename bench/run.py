@@ -0,0 +1,208 @@
+from argparse import ArgumentParser
+from datetime import datetime
+import os
+import resource
+import tempfile
+import threading
+import time
+from bench.site import FixtureSite, SEARCH_NAME, cutsheet_html
+from cutsheet import parse_cutsheet, PARSER
+from metrics import Metrics, process_tree_rss
+from retries import RetryQueue
+from sessionstore import SessionStore
+from urlstore import UrlStore
+
+'''
+Benchmarks the scraper against the local fixture site in bench/site.py, so changes can be measured offline
+Run it from the top of the repo, e.g. `python -m bench.run --listings 200 --latency 0.05 --fail-rate 0.05`
+  * parser        parse_cutsheet() on pages generated in memory, no browser or server needed
+  * scrape_urls   Viewpoint.scrape_urls() on the cutsheet URLs, with --direct-fetch to skip the browser
+  * scrape_index  Viewpoint.scrape_index() on the saved search, clicking through every page
+With --tabs K, both scrape_* benchmarks run through tabs.TabEngine with K tabs instead, and
+--fetch-profile picks what the browser downloads (see viewpoint.FETCH_PROFILES)
+Each one reports listings/min, the p50 and p99 time per listing, and the peak memory of this process
+plus its children (chromedriver and Chrome), and the browser ones the KB downloaded per page
+Results are printed, and appended to --out if it's given
+'''
+
+
+# The value at quantile 'q' (0-1) of 'values', interpolating between the two nearest
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    pos = (len(values) - 1) * q
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+# Samples the memory of this process and its children every 'interval' seconds, keeping the peak
+class PeakRss:
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        rss = process_tree_rss(os.getpid())
+        if rss is None:  # No /proc, so settle for the peak of this process on its own
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        self.peak = max(self.peak, rss)
+
+
+# One line of results for the benchmark 'name', given the seconds each listing took
+# 'kb_per_page' is what the browser downloaded per page, if it was measured
+def report(name, latencies, elapsed, peak_mb, scraped=None, kb_per_page=None):
+    scraped = len(latencies) if scraped is None else scraped
+    line = ('{name:<14} {n:>5} listings  {rate:>9.1f}/min  p50 {p50:>8.1f} ms  p99 {p99:>8.1f} ms  '
+            'peak RSS {rss:>7.1f} MB').format(
+        name=name, n=scraped, rate=scraped / elapsed * 60 if elapsed else 0,
+        p50=percentile(latencies, 0.5) * 1000, p99=percentile(latencies, 0.99) * 1000, rss=peak_mb)
+    if kb_per_page is not None:
+        line += '  {0:>7.1f} KB/page'.format(kb_per_page)
+    return line
+
+
+def bench_parser(args):
+    pages = [cutsheet_html(i) for i in range(1, args.listings + 1)]
+    latencies = list()
+    with PeakRss() as rss:
+        start = time.perf_counter()
+        for page in pages:
+            page_start = time.perf_counter()
+            parse_cutsheet(page)
+            latencies.append(time.perf_counter() - page_start)
+        elapsed = time.perf_counter() - start
+    return report('parser', latencies, elapsed, rss.peak)
+
+
+# A logged-in session on the fixture site, writing everything into 'tmp' instead of data/ and logs/
+def _session(site, tmp, args, **kwargs):
+    import viewpoint as vp  # Only the browser benchmarks need Selenium
+    return vp.Viewpoint(
+        'bench@example.com', 'hunter2',
+        headless=not args.show,
+        log=os.path.join(tmp, 'viewpointer.log'),
+        out_path=os.path.join(tmp, 'listings.jsonl'),
+        fail_path=os.path.join(tmp, 'failed.log'),
+        retries=RetryQueue(os.path.join(tmp, 'retries.db')),
+        session_store=SessionStore(os.path.join(tmp, 'session.json')),
+        fetch_profile=args.fetch_profile,
+        url_store=UrlStore(os.path.join(tmp, 'urls.db')),
+        politeness=args.politeness,
+        jitter=0,
+        metrics=Metrics(os.path.join(tmp, 'metrics.json')),
+        login_url=site.login_url,
+        **kwargs)
+
+
+def bench_scrape_urls(args, site, tmp):
+    from tabs import TabEngine
+    session = _session(site, tmp, args, direct_fetch=args.direct_fetch)
+    latencies = list()
+    try:
+        with PeakRss() as rss:
+            start = time.perf_counter()
+            if args.tabs:
+                engine = TabEngine(session, tabs=args.tabs, on_listing=lambda url, secs: latencies.append(secs))
+                engine.scrape_urls(site.cutsheet_urls())
+            else:
+                for url in site.cutsheet_urls():
+                    url_start = time.perf_counter()
+                    session.scrape_url(url)
+                    latencies.append(time.perf_counter() - url_start)
+            elapsed = time.perf_counter() - start
+        scraped = session.metrics.counters.get('listings', 0)
+        kb_per_page = session.metrics.snapshot()['kb_per_page']
+    finally:
+        session.quit()
+    name = 'scrape_urls' + (' (direct)' if args.direct_fetch else '') + (' (tabs)' if args.tabs else '')
+    return report(name, latencies, elapsed, rss.peak, scraped=scraped, kb_per_page=kb_per_page)
+
+
+def bench_scrape_index(args, site, tmp):
+    from tabs import TabEngine
+    session = _session(site, tmp, args)
+    latencies = list()
+    last = [0.0]
+
+    def after_listing(_):
+        now = time.perf_counter()
+        latencies.append(now - last[0])
+        last[0] = now
+
+    try:
+        session.open_saved_search(SEARCH_NAME)
+        with PeakRss() as rss:
+            start = last[0] = time.perf_counter()
+            if args.tabs:
+                engine = TabEngine(session, tabs=args.tabs, on_listing=lambda url, secs: latencies.append(secs))
+                engine.scrape_index()
+            else:
+                session.scrape_index(after_listing=after_listing)
+            elapsed = time.perf_counter() - start
+        scraped = session.metrics.counters.get('listings', 0)
+        kb_per_page = session.metrics.snapshot()['kb_per_page']
+    finally:
+        session.quit()
+    return report('scrape_index' + (' (tabs)' if args.tabs else ''), latencies, elapsed, rss.peak, scraped=scraped,
+                  kb_per_page=kb_per_page)
+
+
+BENCHMARKS = {'parser': bench_parser, 'scrape_urls': bench_scrape_urls, 'scrape_index': bench_scrape_index}
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('benchmarks', nargs='*', default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument('--listings', type=int, default=100)
+    parser.add_argument('--per-page', type=int, default=20)
+    # Seconds the fixture site waits before every response, give or take --jitter
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    # Share of listings that are broken, either without a print button or with a blank cutsheet
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    # Share of listings whose print button is a JavaScript button rather than a link
+    parser.add_argument('--js-print-rate', type=float, default=0.0)
+    parser.add_argument('--politeness', type=float, default=0.0)
+    parser.add_argument('--direct-fetch', action='store_true')
+    parser.add_argument('--tabs', type=int, default=0)
+    parser.add_argument('--fetch-profile', default='full', choices=['full', 'lean'])
+    parser.add_argument('--show', action='store_true', help='Run Chrome with a window instead of headless')
+    parser.add_argument('--out', default=None, help='Append the results to this file, e.g. bench_output.txt')
+    args = parser.parse_args()
+
+    lines = ['# {dt}  listings={n} latency={l} fail_rate={f} js_print_rate={j} parser={p} fetch_profile={fp}'.format(
+        dt=datetime.now().strftime('%Y-%m-%d %H:%M:%S'), n=args.listings, l=args.latency,
+        f=args.fail_rate, j=args.js_print_rate, p=PARSER, fp=args.fetch_profile)]
+    print(lines[0])
+    for name in args.benchmarks:
+        # Every benchmark gets a fresh site and scratch directory, so nothing is skipped as already scraped
+        with tempfile.TemporaryDirectory() as tmp:
+            if name == 'parser':
+                line = bench_parser(args)
+            else:
+                with FixtureSite(listings=args.listings, per_page=args.per_page, latency=args.latency,
+                                 jitter=args.jitter, fail_rate=args.fail_rate,
+                                 js_print_rate=args.js_print_rate) as site:
+                    line = BENCHMARKS[name](args, site, tmp)
+        print(line)
+        lines.append(line)
+
+    if args.out:
+        with open(args.out, 'a') as file:
+            file.write('\n'.join(lines) + '\n')
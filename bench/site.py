@@ -0,0 +1,216 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from datetime import date, timedelta
+import random
+import threading
+import time
+
+SEARCH_NAME = 'Everything WithinDay'
+_COOKIE = 'vp_session=bench'
+
+_STREETS = ['Robie St', 'Quinpool Rd', 'Agricola St', 'Portland St', 'Main St', 'Herring Cove Rd']
+_CITIES = [('Halifax', 'B3H'), ('Halifax', 'B3K'), ('Dartmouth', 'B2Y'), ('Bedford', 'B4A'), ('Truro', 'B2N')]
+
+
+# A page of the pretend site, with enough filler to be about as heavy as the real thing
+def _page(title, body, filler=40):
+    padding = '\n'.join('<div class="nav-item"><span>Menu item {0}</span></div>'.format(i) for i in range(filler))
+    return ('<!DOCTYPE html><html><head><title>{title} - ViewPoint.ca</title></head>'
+            '<body><div class="header">{padding}</div>{body}</body></html>').format(
+        title=title, body=body, padding=padding)
+
+
+# The printable cutsheet for listing number 'listing_id', the same every time for the same ID
+# 'blank' serves one that didn't load properly, which the real site does every so often
+def cutsheet_html(listing_id, blank=False):
+    rng = random.Random(listing_id)
+    if blank:
+        return _page('', '<div class="row-fluid printsmall"></div>')
+    city, fsa = rng.choice(_CITIES)
+    title = '{n} {street}, {city}, NS {fsa} {d}{l}{d2}'.format(
+        n=rng.randint(1, 9999), street=rng.choice(_STREETS), city=city, fsa=fsa,
+        d=rng.randint(0, 9), l=rng.choice('ABCEGHJKLMNPRSTVXY'), d2=rng.randint(0, 9))
+    listed = date(2020, 1, 1) + timedelta(days=rng.randint(0, 300))
+    rows = [
+        'Price: ${0:,}'.format(rng.randint(150, 900) * 1000),
+        'MLS® # 20{0:07d}'.format(listing_id),
+        'Status: Active',
+        'List Date: {0}'.format(listed),
+        'PID {0:08d}'.format(rng.randint(0, 99999999)),
+        'Type Single Family',
+        'Building Style 2 Storey',
+        'Bedrooms: {0}'.format(rng.randint(1, 6)),
+        'Bathrooms: {0}'.format(rng.randint(1, 4)),
+        'Sq. Footage {0:,}'.format(rng.randint(600, 3500)),
+        'Building Age: {0}'.format(rng.randint(0, 120)),
+        'Assessment ${0:,} ({1})'.format(rng.randint(100, 800) * 1000, 2020),
+        'Heating: Baseboard',
+        'Water: Municipal',
+        'Sewer: Municipal',
+        'Listed By Bench Realty',
+    ]
+    body = '<div class="row-fluid printsmall">{desc}</div><ul>{rows}</ul>'.format(
+        desc=' '.join(['A lovely home close to everything.'] * rng.randint(3, 12)),
+        rows=''.join('<li class="row"><span>{0}</span></li>'.format(row) for row in rows))
+    return _page(title, body)
+
+
+'''
+A local stand-in for the parts of Viewpoint the scraper uses, so it can be benchmarked offline
+  * /user/login has the email/password form with the '.big' button, and sets the session cookie
+  * /dashboard and /saved-searches lead to the saved search named SEARCH_NAME
+  * /search?page=N is the index, with 'days on market' links to each listing and a 'NEXT »' link
+  * /property/ID is the pretty listing page with its 'cutsheet-print' button
+  * /cutsheet/ID?print=1 is the printable cutsheet
+Every response is delayed by 'latency' seconds (give or take 'jitter'), and 'fail_rate' of the listings
+are broken: half of them have no print button and the other half serve a blank cutsheet
+'js_print_rate' of the listings have a print button that opens the cutsheet from JavaScript instead of
+being a link, so there's no URL to follow and it has to be clicked
+Pages that need a session send you back to the login form without the cookie, like the real site
+'''
+class FixtureSite:
+    def __init__(self, listings=100, per_page=20, latency=0.0, jitter=0.0, fail_rate=0.0, js_print_rate=0.0,
+                 seed=0, port=0):
+        self.listings = listings
+        self.per_page = per_page
+        self.latency = latency
+        self.jitter = jitter
+        rng = random.Random(seed)
+        broken = [i for i in range(1, listings + 1) if rng.random() < fail_rate]
+        self.no_print = set(broken[::2])
+        self.blank = set(broken[1::2])
+        self.js_print = {i for i in range(1, listings + 1) if rng.random() < js_print_rate}
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+
+    @property
+    def login_url(self):
+        return self.url + '/user/login'
+
+    # The URLs of every listing's printable cutsheet, and of every listing's pretty page
+    def cutsheet_urls(self):
+        return [self.url + '/cutsheet/{0}?print=1'.format(i) for i in range(1, self.listings + 1)]
+
+    def property_urls(self):
+        return [self.url + '/property/{0}'.format(i) for i in range(1, self.listings + 1)]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def delay(self):
+        with self._lock:
+            self.requests += 1
+        wait = self.latency + (random.uniform(-self.jitter, self.jitter) if self.jitter else 0)
+        if wait > 0:
+            time.sleep(wait)
+
+    # Render the page at 'path', returns (status, html, headers)
+    def render(self, path, query, logged_in):
+        if path == '/user/login':
+            form = ('<form method="post" action="/user/login">'
+                    '<input type="text" name="email"><input type="password" name="password">'
+                    '<button type="submit" class="big">Log in</button></form>')
+            return 200, _page('Log in', form), {}
+        if not logged_in:
+            return 200, _page('Log in', '<form><input name="email"><input name="password"></form>'), {}
+
+        if path in ('/', '/dashboard-home'):
+            return 200, _page('Home', '<a href="/dashboard">DASHBOARD</a>'), {}
+        if path == '/dashboard':
+            return 200, _page('Dashboard', '<a href="/saved-searches">SAVED SEARCHES</a>'), {}
+        if path == '/saved-searches':
+            return 200, _page('Saved searches', '<a href="/search?page=1">{0}</a>'.format(SEARCH_NAME)), {}
+
+        if path == '/search':
+            page = int(query.get('page', ['1'])[0])
+            first = (page - 1) * self.per_page + 1
+            last = min(page * self.per_page, self.listings)
+            links = ''.join('<div class="listing"><a href="/property/{i}">{d} days on market</a></div>'.format(
+                i=i, d=i % 30 + 1) for i in range(first, last + 1))
+            if last < self.listings:
+                links += '<a href="/search?page={0}">NEXT »</a>'.format(page + 1)
+            return 200, _page('Search results, page {0}'.format(page), links), {}
+
+        parts = path.strip('/').split('/')
+        if len(parts) == 2 and parts[1].isdigit() and 1 <= int(parts[1]) <= self.listings:
+            listing_id = int(parts[1])
+            if parts[0] == 'property':
+                if listing_id in self.no_print:
+                    button = ''
+                elif listing_id in self.js_print:
+                    button = ('<button class="cutsheet-print" onclick="window.open(\'/cutsheet/{0}?print=1\', '
+                              '\'_blank\');">Print</button>').format(listing_id)
+                else:
+                    button = ('<a class="cutsheet-print" href="/cutsheet/{0}?print=1" '
+                              'target="_blank">Print</a>').format(listing_id)
+                return 200, _page('Listing {0}'.format(listing_id), button), {}
+            if parts[0] == 'cutsheet':
+                return 200, cutsheet_html(listing_id, blank=listing_id in self.blank), {}
+        return 404, _page('Not found', ''), {}
+
+    def _handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                site.delay()
+                url = urlparse(self.path)
+                logged_in = _COOKIE in (self.headers.get('Cookie') or '')
+                status, html, headers = site.render(url.path, parse_qs(url.query), logged_in)
+                self.send(status, html, headers)
+
+            # Logging in just hands out the cookie, any email and password will do
+            def do_POST(self):
+                site.delay()
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                self.send(303, '', {'Location': '/dashboard-home', 'Set-Cookie': _COOKIE + '; Path=/'})
+
+            def send(self, status, html, headers):
+                body = html.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+# Serve the site until it's interrupted, e.g. `python -m bench.site 8000` to poke at it in a browser
+if __name__ == '__main__':
+    import sys
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    with FixtureSite(port=port, fail_rate=0.05) as site:
+        print('Serving the fixture site on ' + site.login_url)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,90 @@
+from datetime import datetime
+import json
+import os
+import threading
+from writer import RecordWriter
+
+
+'''
+Keeps track of how far a crawl of an index has gotten, so it can pick up where it left off
+It records the saved search being crawled, the output file, the page we're on (and the URL of
+each page), and the listings that have been processed. It's saved to 'path' as JSON after every
+page and every listing, and removed once the crawl finishes
+'''
+class Checkpoint:
+    def __init__(self, path='logs/checkpoint.json', search=None, out_path=None):
+        self.path = path
+        self.search = search
+        self.out_path = out_path
+        self.page = 1
+        self.page_urls = dict()  # Page number (as a str, like in the JSON) to the URL it was on
+        self.processed = set()  # Listing IDs (usually the link from the index) that are done
+        self.started = str(datetime.now())
+        self._lock = threading.Lock()
+
+    # Load the checkpoint saved at 'path', returns None if there isn't one
+    @classmethod
+    def load(cls, path='logs/checkpoint.json'):
+        try:
+            with open(path, 'r') as file:
+                state = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        checkpoint = cls(path, search=state['search'], out_path=state['out_path'])
+        checkpoint.page = state['page']
+        checkpoint.page_urls = state['page_urls']
+        checkpoint.processed = set(state['processed'])
+        checkpoint.started = state['started']
+        return checkpoint
+
+    # Record that we've moved to page number 'page', which is at 'url'
+    def start_page(self, page, url):
+        with self._lock:
+            self.page = page
+            self.page_urls[str(page)] = url
+            self._save()
+
+    # Record that the listing 'listing_id' has been processed, whether it worked or not
+    # It's saved once the records written so far are on disk, so resuming doesn't skip one that was lost
+    def done(self, listing_id):
+        if self.out_path:
+            RecordWriter.open(self.out_path).after_flush(lambda: self._done(listing_id))
+        else:
+            self._done(listing_id)
+
+    def _done(self, listing_id):
+        with self._lock:
+            self.processed.add(listing_id)
+            self._save()
+
+    # The URL that page number 'page' was on, if it's different from the first page's URL
+    # An index that doesn't put the page in the URL can't be jumped into, it has to be paged through
+    def page_url(self, page):
+        url = self.page_urls.get(str(page))
+        if url and url != self.page_urls.get('1'):
+            return url
+        return None
+
+    # The crawl is done, so there's nothing to resume
+    def finish(self):
+        with self._lock:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    # Write to a temporary file and swap it in, so a crash mid-write never leaves a broken checkpoint
+    def _save(self):
+        state = {
+            'search': self.search,
+            'out_path': self.out_path,
+            'page': self.page,
+            'page_urls': self.page_urls,
+            'processed': sorted(self.processed),
+            'started': self.started,
+            'saved': str(datetime.now()),
+        }
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as file:
+            json.dump(state, file)
+        os.replace(tmp, self.path)
@@ -0,0 +1,92 @@
+from bs4 import BeautifulSoup, SoupStrainer
+from collections import namedtuple
+import re
+
+# lxml is much faster than the built-in parser, but fall back to html.parser if it isn't installed
+try:
+    import lxml  # noqa: F401
+    PARSER = 'lxml'
+except ImportError:
+    PARSER = 'html.parser'
+
+# Everything we scrape out of one printable cutsheet
+# 'rows' is the list of 'li.row' fields in the order they appear on the page, with whitespace collapsed
+Cutsheet = namedtuple('Cutsheet', ['title', 'description', 'rows'])
+
+
+# Only the title, the description div and the 'li.row' data table are ever read,
+# so tell BeautifulSoup not to build the rest of the tree
+def _wanted(name, attrs=None):
+    if name == 'title':
+        return True
+    if name not in ('div', 'li') or not attrs:
+        return False
+    classes = attrs.get('class', '')
+    if isinstance(classes, str):
+        classes = classes.split()
+    if name == 'li':
+        return 'row' in classes
+    return 'row-fluid' in classes and 'printsmall' in classes
+
+
+# SoupStrainer only passes the tag name to a function, but we need the class too
+# BeautifulSoup 4.13+ asks allow_tag_creation(), older versions ask search_tag()
+class _CutsheetStrainer(SoupStrainer):
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        return _wanted(name, attrs)
+
+    def search_tag(self, markup_name=None, markup_attrs={}):
+        return _wanted(markup_name, markup_attrs)
+
+
+_STRAINER = _CutsheetStrainer('title')
+
+
+# Parse the HTML of a printable cutsheet (str or bytes) into a Cutsheet
+# Doesn't need a browser, so archived pages can be re-parsed offline
+# Missing fields come back empty: title is '' and description is None
+def parse_cutsheet(html, parser=PARSER):
+    listing = BeautifulSoup(html, parser, parse_only=_STRAINER)
+
+    # Take "ViewPoint.ca" out of the title
+    title = listing.find('title')
+    title = re.sub(' - ViewPoint.ca', '', title.text).strip() if title else ''
+
+    desc = listing.find('div', {'class': 'row-fluid printsmall'})
+    desc = desc.text.strip() if desc else None
+
+    # Get the data table and write it to an ugly list
+    rows = [' '.join(line.text.split()) for line in listing.find_all('li', {'class': 'row'})]
+    return Cutsheet(title, desc, rows)
+
+
+# The record written for a cutsheet loaded from 'url' at 'scraped' (a str like str(datetime.now())), see writer.py
+def to_record(cutsheet, url, scraped):
+    return {'datetime': scraped, 'title': cutsheet.title, 'url': url,
+            'description': cutsheet.description if cutsheet.description is not None else 'Missing description',
+            'fields': cutsheet.rows}
+
+
+# Sometimes the cutsheets aren't served properly, this checks whether the title looks like an address
+def is_valid(cutsheet):
+    return len(cutsheet.title) > 10 and cutsheet.title != 'about:blank'
+
+
+# Re-parse saved cutsheets offline, e.g. `python cutsheet.py pages/*.html`
+# Prints how long the parsing took, which is handy for profiling the parser on its own
+if __name__ == '__main__':
+    import sys
+    import time
+
+    paths = sys.argv[1:]
+    pages = list()
+    for path in paths:
+        with open(path, 'rb') as file:
+            pages.append(file.read())
+
+    start = time.perf_counter()
+    parsed = [parse_cutsheet(page) for page in pages]
+    elapsed = time.perf_counter() - start
+    print('Parsed {n} pages ({v} valid) with {p} in {t:.2f} secs ({r:.0f} pages/sec)'.format(
+        n=len(parsed), v=sum(is_valid(c) for c in parsed), p=PARSER,
+        t=elapsed, r=len(parsed) / elapsed if elapsed else 0))
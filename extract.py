@@ -0,0 +1,383 @@
+from datetime import datetime, timezone, date
+from functools import lru_cache
+import hashlib
+import re
+import string
+
+# A Python port of parse_row() in cleanup-functions.R and the small cleanups in 03-cleanup-scraped.R
+# It turns one scraped record (see writer.py) into the columns of the 'properties' and 'updates' tables
+
+# Fields that are expected to return factors/character strings, in the same order as parse_row()
+# The prefix is regex'd out, so it needs to match exactly (missing whitespace is OK)
+FIELDS_FCT = [
+    ("Sewer:", "sewer"),
+    ("Water:", "water"),
+    ("Lising Size:", "listing_size"),
+    ("Heating:", "heating"),
+    ("Land Features:", "land_features"),
+    ("Status:", "status"),
+    ("MLS® #", "mls_no"),
+    ("PID", "pid"),
+    ("Lot Size", "lot_size"),
+    ("Listed By", "agent"),
+    ("Garage Type:", "garage_type"),
+    ("Fuel Type:", "fuel_type"),
+    ("Type", "type"),
+    ("Building Style", "building_style"),
+    ("Style", "style"),
+    ("Foundation:", "foundation"),
+    ("Basement:", "basement"),
+    ("Driveway/Pkg:", "driveway"),
+    ("Utilities:", "utilities"),
+    ("Features:", "features"),
+    ("Roof:", "roof"),
+    ("Flooring:", "flooring"),
+    ("Garage:", "garage"),
+    ("Waterfront:", "waterfront"),
+    ("Rental Equipment:", "rental_equipment"),
+    ("Exterior:", "exterior"),
+    ("Elementary School:", "school_elem"),
+    ("Jr High School:", "school_jrhigh"),
+    ("High School:", "school_high"),
+    ("Compliments of:", "compliments_of"),
+]
+
+# Fields that are expected to return numerics, the number is extracted so the prefix doesn't need to be exact
+FIELDS_NUM = [
+    ("Sq. Footage", "sqft_mla"),
+    ("Total Fin Sq. Footage", "sqft_tla"),
+    ("Prov. Parcel Size", "parcel_size"),
+    ("Bedrooms:", "bedrooms"),
+    ("Bathrooms:", "bathrooms"),
+    ("Building Age:", "building_age"),
+]
+
+# Like the R versions, the labels are used as regexes as-is
+_REGEX_FCT = re.compile('|'.join(label for label, _ in FIELDS_FCT))
+_REGEX_NUM = re.compile('|'.join(label for label, _ in FIELDS_NUM))
+_COLUMNS_FCT = dict(FIELDS_FCT)
+_COLUMNS_NUM = dict(FIELDS_NUM)
+
+_MONEY = re.compile(r'\$\d*,?\d*,*\d+')
+_NUMBER = re.compile(r'\d*,?\d*,*\d+\.*\d*')
+_YEAR = re.compile(r'\((\d{4})\)')
+_DATE = re.compile(r'20\d{2}-\d{2}-\d{2}')
+_POSTAL = re.compile(r'[A-Za-z]\d[A-Za-z][ -]?\d[A-Za-z]\d')
+_UNIT = re.compile(r'Unit (\d+)')
+
+# Postal code areas on the Halifax peninsula and in the rest of HRM, from setup-constants.R
+PENINSULA_CODES = {"B3H": "South End", "B3J": "Downtown", "B3K": "North End", "B3L": "West End"}
+HRM_POSTALS = ({"B2" + x for x in "VWXYZ"} |
+               {"B3" + x for x in string.ascii_uppercase} |
+               {"B4" + x for x in "ABCDEFG"})
+
+# Columns that are numbers in the database
+INTEGER_COLS = ["update_id", "prop_id", "price", "days_on_market", "mls_no", "pid", "assessment",
+                "assessment_year", "bedrooms", "bathrooms", "sqft_mla", "sqft_tla", "building_age"]
+
+# The columns that describe one scrape of a listing, everything else describes the property
+UPDATE_COLS = ["update_id", "prop_id", "datetime", "status", "price", "days_on_market", "source_file"]
+
+
+# For x with a price listed as $1,000,000.00, return 1000000
+def extract_money(x):
+    match = _MONEY.search(x)
+    return float(match.group(0).replace(',', '').replace('$', '')) if match else None
+
+
+# For x with a value listed as 1,000,000.00, return 1000000
+def extract_number(x):
+    match = _NUMBER.search(x)
+    if not match:
+        return None
+    try:
+        return float(match.group(0).replace(',', ''))
+    except ValueError:
+        return None
+
+
+# For x = 'prefix: data' return 'data'
+def drop_prefix(x, prefix):
+    out = re.sub(prefix, '', x, count=1).strip()
+    if out == 'Yes':
+        return 'TRUE'
+    if out == 'No':
+        return 'FALSE'
+    if out in ('', 'N/A', 'None'):
+        return None
+    return out
+
+
+# Whole numbers come back as ints so they're stored as integers
+def _as_number(x):
+    if x is None:
+        return None
+    if isinstance(x, str):
+        try:
+            x = float(x.replace(',', ''))
+        except ValueError:
+            return None
+    return int(x) if float(x).is_integer() else x
+
+
+# Turn the naive local timestamp the scraper writes into UTC, like as_datetime() does in R
+def _to_utc(timestamp):
+    return datetime.fromisoformat(timestamp).astimezone(timezone.utc)
+
+
+# A fingerprint of everything a cutsheet says, to tell whether a listing has changed since it was last scraped
+# Whitespace is collapsed first, so the same listing rendered a bit differently gives the same fingerprint
+# Days on market isn't on the cutsheet (it's counted from the list date), so it doesn't change it
+def fingerprint(title, description, fields):
+    parts = [title or '', description or ''] + list(fields or [])
+    text = '\x1f'.join(' '.join(part.split()) for part in parts)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+# Parse the 'li.row' fields of a cutsheet into a dict of columns, given when it was scraped
+def parse_fields(fields, scraped):
+    out = dict()
+    for field in fields:
+        # Handle the 'Price' field by extracting the number, removing commas
+        if 'Price' in field:
+            out['price'] = extract_money(field)
+
+        # Parse out the assessment, we need the year and the dollar value out of it
+        if 'Assessment' in field:
+            out['assessment'] = extract_money(field)
+            year = _YEAR.search(field)
+            out['assessment_year'] = int(year.group(1)) if year else None
+
+        if 'Condo Fee' in field:
+            out['condo_fee'] = extract_money(field)
+
+        # Parse out the listing date and calculate days on the market
+        if 'List Date' in field:
+            date = _DATE.search(field)
+            if date:
+                list_date = datetime.strptime(date.group(0), '%Y-%m-%d').date()
+                out['list_date'] = str(list_date)
+                out['days_on_market'] = (scraped.date() - list_date).days
+
+        # Handle fields that are factors
+        match = _REGEX_FCT.search(field)
+        if match:
+            out[_COLUMNS_FCT[match.group(0)]] = drop_prefix(field, match.group(0))
+
+        # Handle fields that are numeric
+        match = _REGEX_NUM.search(field)
+        if match:
+            out[_COLUMNS_NUM[match.group(0)]] = extract_number(field)
+    return out
+
+
+# Parse one scraped record into a dict of columns, with the cleanups from 03-cleanup-scraped.R
+# The columns that need the database (prop_id, postal_city, loc_bin) are left to the caller
+def parse_record(record, source_file=None):
+    scraped = _to_utc(record['datetime'])
+    out = {'datetime': scraped.strftime('%Y-%m-%d %H:%M:%S')}
+
+    # Split the "address" field into the street address and the postal code
+    address = record['title']
+    postal = _POSTAL.search(address)
+    postal = postal.group(0) if postal else None
+    if postal:
+        address = address.replace(', ' + postal, '', 1)
+        # If there's no space in the postal code, add one
+        if len(postal) == 6 and ' ' not in postal:
+            postal = postal[:3] + ' ' + postal[3:]
+    out['postal'] = postal
+    out['postal_first'], out['postal_last'] = re.split('[ -]', postal, maxsplit=1) if postal else (None, None)
+
+    # Put the unit numbers for apartments/condos into their own column, take it out of the address
+    unit = _UNIT.search(address)
+    out['unit'] = unit.group(1) if unit else None
+    address = re.sub(r'Unit \d+ ', '', address)
+    out['address'] = address
+    out['street'], _, out['city'] = address.partition(', ')
+    out['city'] = out['city'] or None
+
+    # Fix the URL so following it doesn't bring up a print preview automatically
+    out['url'] = record['url'].replace('&print=1', '') if record.get('url') else None
+    out['description'] = record.get('description')
+
+    out.update(parse_fields(record.get('fields') or [], scraped))
+
+    for col in INTEGER_COLS:
+        if col in out:
+            out[col] = _as_number(out[col])
+
+    # Catches bug where the last two digits of the price don't come through
+    if out.get('price') is not None and out['price'] < 10000:
+        out['price'] = out['price'] * 100
+
+    # A unique ID for each row: the scrape time in whole seconds followed by digits 5-9 of the MLS number
+    if out.get('mls_no') is not None:
+        out['update_id'] = int('{0}{1}'.format(int(scraped.timestamp()), str(out['mls_no'])[4:9]))
+    else:
+        out['update_id'] = None
+    out['source_file'] = source_file
+    return out
+
+
+# Batch version of parse_record() ----------------------------------------------------------------------
+# A day's records share most of their fields ('Water: Municipal', 'Status: Active', ...) and a lot of
+# their titles, so each distinct string is classified once and the numbers are typed a column at a time
+
+_EPOCH_DAY = date(1970, 1, 1).toordinal()
+
+
+# What one 'li.row' field sets, as a tuple of (column, kind, value):
+#   'value'  value is stored as-is
+#   'number' value is a string of digits (or None), typed along with the rest of its column
+#   'date'   value is the list date's day number, days_on_market is counted from it
+@lru_cache(maxsize=100000)
+def _classify(field):
+    out = list()
+    if 'Price' in field:
+        out.append(('price', 'number', _money_digits(field)))
+    if 'Assessment' in field:
+        out.append(('assessment', 'number', _money_digits(field)))
+        year = _YEAR.search(field)
+        out.append(('assessment_year', 'value', int(year.group(1)) if year else None))
+    if 'Condo Fee' in field:
+        out.append(('condo_fee', 'number', _money_digits(field)))
+    if 'List Date' in field:
+        found = _DATE.search(field)
+        if found:
+            list_date = datetime.strptime(found.group(0), '%Y-%m-%d').date()
+            out.append(('list_date', 'value', str(list_date)))
+            out.append(('days_on_market', 'date', list_date.toordinal() - _EPOCH_DAY))
+    match = _REGEX_FCT.search(field)
+    if match:
+        column = _COLUMNS_FCT[match.group(0)]
+        value = drop_prefix(field, match.group(0))
+        out.append((column, 'value', _as_number(value) if column in INTEGER_COLS else value))
+    match = _REGEX_NUM.search(field)
+    if match:
+        found = _NUMBER.search(field)
+        digits = found.group(0).replace(',', '') if found else None
+        out.append((_COLUMNS_NUM[match.group(0)], 'number', digits if _is_float(digits) else None))
+    return tuple(out)
+
+
+def _money_digits(x):
+    match = _MONEY.search(x)
+    return match.group(0).replace(',', '').replace('$', '') if match else None
+
+
+def _is_float(x):
+    try:
+        float(x)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+# The columns that come from the title: postal, postal_first, postal_last, unit, address, street, city
+@lru_cache(maxsize=100000)
+def _split_title(address):
+    postal = _POSTAL.search(address)
+    postal = postal.group(0) if postal else None
+    if postal:
+        address = address.replace(', ' + postal, '', 1)
+        if len(postal) == 6 and ' ' not in postal:
+            postal = postal[:3] + ' ' + postal[3:]
+    postal_first, postal_last = re.split('[ -]', postal, maxsplit=1) if postal else (None, None)
+    unit = _UNIT.search(address)
+    address = re.sub(r'Unit \d+ ', '', address)
+    street, _, city = address.partition(', ')
+    return postal, postal_first, postal_last, unit.group(1) if unit else None, address, street, city or None
+
+
+# Turn a float array back into Python values like _as_number() does: None for NaN, whole numbers as ints
+def _from_array(values, integer):
+    if integer:
+        return [None if x != x else int(x) if x.is_integer() else x for x in values.tolist()]
+    return [None if x != x else x for x in values.tolist()]
+
+
+# Parse a batch of scraped records at once, giving the same rows as [parse_record(r) for r in records]
+# 'source_files' is one file for every record, or a list with one for each
+def parse_records(records, source_files=None):
+    import numpy as np  # Only needed here, so importing extract.py (e.g. for fingerprint()) stays light
+    n = len(records)
+    if not isinstance(source_files, (list, tuple)):
+        source_files = [source_files] * n
+
+    # Scrape times in whole seconds, then as UTC strings and day numbers
+    epochs = np.array([int(datetime.fromisoformat(r['datetime']).timestamp()) for r in records], dtype=np.int64)
+    stamps = np.char.replace(np.datetime_as_string(epochs.astype('datetime64[s]'), unit='s'), 'T', ' ')
+    days = epochs // 86400
+
+    rows = list()
+    for i, record in enumerate(records):
+        postal, postal_first, postal_last, unit, address, street, city = _split_title(record['title'])
+        rows.append({
+            'datetime': str(stamps[i]), 'postal': postal, 'postal_first': postal_first,
+            'postal_last': postal_last, 'unit': unit, 'address': address, 'street': street, 'city': city,
+            'url': record['url'].replace('&print=1', '') if record.get('url') else None,
+            'description': record.get('description'),
+        })
+
+    # Sort the fields into their columns, numbers are kept as strings for now
+    numbers = dict()  # column -> {row: digits}
+    listed = dict()  # row -> day number of the list date
+    for i, record in enumerate(records):
+        row = rows[i]
+        for field in record.get('fields') or []:
+            for column, kind, value in _classify(field):
+                if kind == 'number':
+                    numbers.setdefault(column, dict())[i] = value
+                elif kind == 'date':
+                    listed[i] = value
+                else:
+                    row[column] = value
+
+    # Type each numeric column in one go
+    for column, values in numbers.items():
+        index = np.fromiter(values.keys(), dtype=np.int64, count=len(values))
+        typed = np.array([np.nan if v is None else v for v in values.values()], dtype=np.float64)
+        if column == 'price':
+            # Catches bug where the last two digits of the price don't come through
+            typed = np.where(typed < 10000, typed * 100, typed)
+        for i, value in zip(index.tolist(), _from_array(typed, column in INTEGER_COLS)):
+            rows[i][column] = value
+    if listed:
+        index = np.fromiter(listed.keys(), dtype=np.int64, count=len(listed))
+        on_market = days[index] - np.fromiter(listed.values(), dtype=np.int64, count=len(listed))
+        for i, value in zip(index.tolist(), on_market.tolist()):
+            rows[i]['days_on_market'] = value
+
+    # update_id is the scrape time followed by digits 5-9 of the MLS number, done with integer maths
+    has_mls = np.array([isinstance(row.get('mls_no'), int) and row['mls_no'] >= 0 for row in rows], dtype=bool)
+    mls = np.array([row['mls_no'] if ok else 0 for row, ok in zip(rows, has_mls)], dtype=np.int64)
+    length = np.char.str_len(mls.astype(str))
+    end = np.minimum(length, 9)
+    width = np.maximum(end - 4, 0)
+    suffix = (mls // 10 ** (length - end)) % 10 ** width
+    update_ids = epochs * 10 ** width + suffix
+    for i, row in enumerate(rows):
+        row['update_id'] = int(update_ids[i]) if has_mls[i] else (None if row.get('mls_no') is None else
+                                                                   _update_id(epochs[i], row['mls_no']))
+        row['source_file'] = source_files[i]
+    return rows
+
+
+# The update_id the slow way, for an MLS number that isn't a plain integer
+def _update_id(epoch, mls_no):
+    return int('{0}{1}'.format(int(epoch), str(mls_no)[4:9]))
+
+
+# Bin a property's location, like the case_when() in 03-cleanup-scraped.R
+def loc_bin(postal_first, postal_city):
+    postal_city = postal_city or ''
+    if postal_first in PENINSULA_CODES:
+        return 'Halifax Peninsula'
+    if 'Halifax' in postal_city:
+        return 'Halifax, Off Peninsula'
+    if 'Dartmouth' in postal_city:
+        return 'Dartmouth'
+    if postal_first in HRM_POSTALS:
+        return 'HRM, Other'
+    return 'Rest of Province'
@@ -0,0 +1,258 @@
+from datetime import datetime, timedelta
+import csv
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import urllib3
+
+# The columns of the 'geocode' table in the listings DB, like get_latlong() in cleanup-functions.R returns
+GEOCODE_COLS = ['address', 'lat', 'lon', 'osm_id', 'osm_type', 'osm_importance', 'osm_displayname', 'place_id']
+_RESULT_COLS = GEOCODE_COLS[1:]
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY, lat REAL, lon REAL, osm_id REAL, osm_type TEXT, osm_importance REAL,
+    osm_displayname TEXT, place_id REAL, looked_up TEXT
+);
+'''
+
+
+# Clean up an address the way get_latlong() does before it's looked up
+def clean_address(address):
+    address = re.sub(r'^Unit [0-9]+ ', '', address)
+    address = re.sub(r'^[0-9]+-', '', address)
+    address = re.sub(r'^Lot ', '', address)
+    address = re.sub(r', Nova Scotia - For Sale \$[0-9]+,[0-9]+', '', address)
+    address = re.sub(r'[\\/><]', '', address)
+    if 'NS, Canada' not in address:
+        address = address + ', NS, Canada'
+    return address
+
+
+# The cache key for an address: cleaned up, lower case, with the spacing and punctuation evened out
+# so '12 Main St., Halifax' and '12  main st, halifax' are looked up once
+def normalize_address(address):
+    key = clean_address(address).lower()
+    key = re.sub(r'[.#]', '', key)
+    key = re.sub(r'\s*,\s*', ', ', key)
+    return re.sub(r'\s+', ' ', key).strip()
+
+
+'''
+Remembers every geocoding result (and every failure) in a SQLite DB, keyed by normalize_address()
+Failures are looked up again once they're older than 'retry_failed_after' days
+'''
+class GeocodeCache:
+    def __init__(self, path='data/geocode-cache.db', retry_failed_after=30):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(_SCHEMA)
+        self.db.commit()
+        self.retry_failed_after = retry_failed_after
+        self._lock = threading.Lock()
+
+    # The cached results for 'keys' as a dict of key to result, leaving out the ones that aren't cached
+    def get_many(self, keys):
+        keys = list(keys)
+        found = dict()
+        retry_before = str(datetime.now() - timedelta(days=self.retry_failed_after))
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                query = 'SELECT key, {cols}, looked_up FROM cache WHERE key IN ({params})'.format(
+                    cols=', '.join(_RESULT_COLS), params=', '.join('?' * len(chunk)))
+                for row in self.db.execute(query, chunk):
+                    result = dict(zip(_RESULT_COLS, row[1:-1]))
+                    if result['lat'] is None and row[-1] < retry_before:
+                        continue
+                    found[row[0]] = result
+        return found
+
+    def put_many(self, results):
+        now = str(datetime.now())
+        with self._lock, self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO cache (key, {cols}, looked_up) VALUES (?, {params}, ?)'.format(
+                    cols=', '.join(_RESULT_COLS), params=', '.join('?' * len(_RESULT_COLS))),
+                [[key] + [result.get(col) for col in _RESULT_COLS] + [now] for key, result in results.items()])
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+'''
+Looks addresses up with OpenStreetMap's Nominatim, like tmaptools::geocode_OSM() does
+Nominatim allows one request a second and no bulk queries, so lookup_many() paces itself
+'''
+class NominatimBackend:
+    def __init__(self, url='https://nominatim.openstreetmap.org/search', user_agent='vistaguide', interval=1.0):
+        self.logger = logging.getLogger('viewpointer')
+        self.url = url
+        self.interval = interval
+        self.http = urllib3.PoolManager(headers={'User-Agent': user_agent},
+                                        retries=urllib3.Retry(total=2, backoff_factor=1))
+        self._last = 0
+
+    # The results for a list of cleaned up addresses, in the same order. A failed lookup is None
+    def lookup_many(self, addresses):
+        return [self.lookup(address) for address in addresses]
+
+    def lookup(self, address):
+        wait = self._last + self.interval - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        self._last = time.monotonic()
+        try:
+            response = self.http.request('GET', self.url, fields={'q': address, 'format': 'json', 'limit': 1})
+            found = json.loads(response.data.decode('utf-8')) if response.status == 200 else list()
+        except (urllib3.exceptions.HTTPError, ValueError) as e:
+            self.logger.warning('Geocoding {a} failed: {e}'.format(a=address, e=e))
+            return None
+        if not found or 'Canada' not in found[0].get('display_name', ''):
+            return None
+        found = found[0]
+        return {'lat': float(found['lat']), 'lon': float(found['lon']), 'osm_id': found.get('osm_id'),
+                'osm_type': found.get('type'), 'osm_importance': found.get('importance'),
+                'osm_displayname': found.get('display_name'), 'place_id': found.get('place_id')}
+
+
+# Stands in for a real backend without the network, e.g. in the benchmarks
+# Answers from 'results' (cleaned up address to result) and fails everything else; 'calls' counts lookups
+class StubBackend:
+    def __init__(self, results=None):
+        self.results = results or dict()
+        self.calls = 0
+
+    def lookup_many(self, addresses):
+        self.calls += len(addresses)
+        return [self.results.get(address) for address in addresses]
+
+
+'''
+Latitude and longitude of the middle of each forward sortation area (the first three characters of a
+postal code) from data/ca-postal-codes.csv, for when an address can't be geocoded
+'''
+class PostalIndex:
+    def __init__(self, path='data/ca-postal-codes.csv'):
+        self.areas = dict()
+        # The accents in some place names are mangled, latin-1 at least reads every byte
+        with open(path, 'r', encoding='latin-1') as file:
+            for row in csv.DictReader(file):
+                self.areas[row['Postal_Code'].upper()] = (float(row['Latitude']), float(row['Longitude']),
+                                                          row['Place_Name'])
+
+    # A result for the area of 'postal' (e.g. 'B3H 1A1' or just 'B3H'), or None if it isn't a known area
+    def lookup(self, postal):
+        if not postal:
+            return None
+        area = self.areas.get(postal.strip()[:3].upper())
+        if area is None:
+            return None
+        lat, lon, place = area
+        return {'lat': lat, 'lon': lon, 'osm_id': None, 'osm_type': 'postal_area', 'osm_importance': None,
+                'osm_displayname': place, 'place_id': None}
+
+
+'''
+Geocodes addresses through the cache, so only the ones it hasn't seen before go to the backend
+Every address in a batch is normalized and deduplicated, the cache is checked for all of them in one
+go, and the rest are handed to the backend together. Addresses the backend can't find get the middle
+of their postal area from the PostalIndex instead, with osm_type 'postal_area'
+'''
+class Geocoder:
+    def __init__(self, cache=None, backend=None, postal_index=None):
+        self.logger = logging.getLogger('viewpointer')
+        self.cache = cache if cache is not None else GeocodeCache()
+        self.backend = backend if backend is not None else NominatimBackend()
+        self.postal_index = postal_index if postal_index is not None else PostalIndex()
+
+    # Geocode a list of addresses, with their postal codes in 'postals' if they're known
+    # Returns a dict of address to a row for the 'geocode' table (see GEOCODE_COLS)
+    def geocode(self, addresses, postals=None):
+        postals = postals or [None] * len(addresses)
+        keys = {address: normalize_address(address) for address in addresses}
+        results = self.cache.get_many(set(keys.values()))
+
+        new = dict()  # Key to the cleaned up address to look up
+        for address, key in keys.items():
+            if key not in results and key not in new:
+                new[key] = clean_address(address)
+        if new:
+            self.logger.info('Geocoding {n} new addresses ({m} cached)'.format(n=len(new), m=len(results)))
+            found = self.backend.lookup_many(list(new.values()))
+            looked_up = {key: result or dict() for key, result in zip(new, found)}
+            self.cache.put_many(looked_up)
+            results.update(looked_up)
+
+        out = dict()
+        for address, postal in zip(addresses, postals):
+            result = results.get(keys[address]) or dict()
+            if result.get('lat') is None:
+                result = self.postal_index.lookup(postal) or result
+            out[address] = dict({col: result.get(col) for col in _RESULT_COLS}, address=address)
+        return out
+
+    def close(self):
+        self.cache.close()
+
+
+# How good a row of the 'geocode' table is: 0 if it failed, 1 for the middle of its postal area, 2 for a real result
+def _quality(lat, osm_type):
+    if lat is None:
+        return 0
+    return 1 if osm_type == 'postal_area' else 2
+
+
+# Add the properties in the listings DB that aren't in its 'geocode' table yet, and give the ones that failed
+# or only got their postal area another go, so they're updated once the cache is willing to look them up again
+# Only those addresses are read, through the index on geocode.address, not the whole table
+# Returns the number of rows that were added or improved
+def geocode_missing(db, geocoder, batch_size=100):
+    db.execute('CREATE TABLE IF NOT EXISTS geocode ({cols})'.format(cols=', '.join(GEOCODE_COLS)))
+    db.execute('CREATE INDEX IF NOT EXISTS geocode_address ON geocode (address)')
+    # -1 for addresses that aren't in 'geocode' at all, otherwise the _quality() of their best row
+    missing = db.execute('''
+        SELECT p.address, MAX(p.postal),
+               MAX(CASE WHEN g.address IS NULL THEN -1 WHEN g.lat IS NULL THEN 0
+                        WHEN g.osm_type = 'postal_area' THEN 1 ELSE 2 END) AS quality
+        FROM properties p LEFT JOIN geocode g ON g.address = p.address
+        WHERE p.address IS NOT NULL
+        GROUP BY p.address HAVING quality < 2
+        ''').fetchall()
+    written = 0
+    for i in range(0, len(missing), batch_size):
+        batch = missing[i:i + batch_size]
+        addresses, postals, qualities = zip(*batch)
+        rows = geocoder.geocode(list(addresses), list(postals))
+        new = [rows[address] for address, quality in zip(addresses, qualities) if quality < 0]
+        better = [rows[address] for address, quality in zip(addresses, qualities)
+                  if 0 <= quality < _quality(rows[address]['lat'], rows[address]['osm_type'])]
+        with db:
+            db.executemany('INSERT INTO geocode ({cols}) VALUES ({params})'.format(
+                cols=', '.join(GEOCODE_COLS), params=', '.join('?' * len(GEOCODE_COLS))),
+                [[row[col] for col in GEOCODE_COLS] for row in new])
+            db.executemany('UPDATE geocode SET {cols} WHERE address = ?'.format(
+                cols=', '.join(col + ' = ?' for col in _RESULT_COLS)),
+                [[row[col] for col in _RESULT_COLS] + [row['address']] for row in better])
+        written += len(new) + len(better)
+    return written
+
+
+# Geocode every property in the listings DB that isn't geocoded yet, e.g. `python geocode.py`
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--db', default='data/listings.db')
+    args = parser.parse_args()
+
+    geocoder = Geocoder()
+    listings = sqlite3.connect(args.db)
+    start = time.perf_counter()
+    n = geocode_missing(listings, geocoder)
+    print('Geocoded {n} addresses in {t:.1f} secs'.format(n=n, t=time.perf_counter() - start))
+    listings.close()
+    geocoder.close()
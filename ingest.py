@@ -0,0 +1,215 @@
+import json
+import logging
+import sqlite3
+import threading
+from extract import parse_records, fingerprint, loc_bin, PENINSULA_CODES, UPDATE_COLS
+
+# Columns of the tables if this has to create them, the R scripts create the full set of columns
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS properties (
+    prop_id INTEGER, last_update TEXT, address TEXT, loc_bin TEXT, postal TEXT, street TEXT, city TEXT,
+    postal_first TEXT, postal_last TEXT, url TEXT, description TEXT, mls_no INTEGER, pid INTEGER,
+    list_date TEXT, assessment INTEGER, assessment_year INTEGER, bedrooms INTEGER, bathrooms INTEGER,
+    sqft_mla INTEGER, sqft_tla INTEGER, lot_size TEXT, agent TEXT, type TEXT, building_style TEXT,
+    parcel_size TEXT, building_age INTEGER, heating TEXT, land_features TEXT, water TEXT, sewer TEXT,
+    foundation TEXT, basement TEXT, driveway TEXT, fuel_type TEXT, utilities TEXT, features TEXT, roof TEXT,
+    flooring TEXT, garage TEXT, garage_type TEXT, waterfront TEXT, rental_equipment TEXT, exterior TEXT,
+    compliments_of TEXT, style TEXT, school_elem TEXT, school_jrhigh TEXT, school_high TEXT,
+    condo_fee INTEGER, unit TEXT, postal_city TEXT, peninsula TEXT, source_file TEXT
+);
+CREATE TABLE IF NOT EXISTS updates (
+    update_id INTEGER, prop_id INTEGER, datetime TEXT, status TEXT, price INTEGER,
+    days_on_market INTEGER, source_file TEXT
+);
+CREATE INDEX IF NOT EXISTS properties_prop_id ON properties (prop_id);
+CREATE INDEX IF NOT EXISTS properties_address_mls ON properties (address, mls_no);
+CREATE INDEX IF NOT EXISTS updates_update_id ON updates (update_id);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    prop_id INTEGER PRIMARY KEY, fingerprint TEXT, datetime TEXT
+);
+'''
+
+
+'''
+Streams scraped records straight into the 'properties' and 'updates' tables of the listings DB
+Records are parsed a batch of 'batch_size' at a time with extract.parse_records() and written together
+Deduplication happens in the database: new properties are matched on (address, mls_no) and
+updates on update_id, both through an index, so nothing gets read into memory in bulk
+Each property's latest fingerprint (see extract.fingerprint) is kept in the 'fingerprints' table, and a
+scrape that's the same as the one before it doesn't get a new row in 'updates'
+It's safe to run 03-cleanup-scraped.R on the same files afterwards, it skips the rows that are already in
+'''
+class Ingestor:
+    def __init__(self, path='data/listings.db', batch_size=50):
+        self.logger = logging.getLogger('viewpointer')
+        self.batch_size = batch_size
+        self._buffer = list()
+        self._lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # WAL lets the report read the DB while we write to it
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(_SCHEMA)
+        self.property_cols = [row[1] for row in self.db.execute('PRAGMA table_info(properties)')]
+        self.update_cols = [col for col in UPDATE_COLS
+                            if col in {row[1] for row in self.db.execute('PRAGMA table_info(updates)')}]
+
+        # The NS postal codes are small enough to keep in memory
+        try:
+            self.postals = dict(self.db.execute(
+                'SELECT postal_code, place_name FROM postals WHERE province = \'NS\''))
+        except sqlite3.OperationalError:
+            self.postals = dict()
+        self.db.commit()
+
+    # Queue a scraped record (see writer.py) to be written, 'source_file' is the file it was scraped to
+    def add(self, record, source_file=None):
+        with self._lock:
+            self._buffer.append((record, source_file))
+            if len(self._buffer) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        records, source_files = zip(*self._buffer)
+        rows = parse_records(records, list(source_files))
+        self._buffer = list()
+        for row, record in zip(rows, records):
+            row['fingerprint'] = fingerprint(record['title'], record.get('description'), record.get('fields'))
+        rows = [row for row in rows if row['address'] and row['datetime']]
+
+        with self.db:
+            new_properties = self._assign_prop_ids(rows)
+            changed = self._changed(rows)
+            self._insert_properties(new_properties)
+            n_updates = self._insert_updates(changed)
+        self.logger.debug('Ingested {n} rows: {p} new properties, {u} new updates, {c} unchanged'.format(
+            n=len(rows), p=len(new_properties), u=n_updates, c=len(rows) - len(changed)))
+
+    # The rows that are different from the scrape of the same property before them, oldest first
+    # Rows older than the newest fingerprint (e.g. from a backfill) are passed through, update_id dedupes them
+    # The fingerprints table is moved up to the newest row of each property
+    def _changed(self, rows):
+        latest = dict()  # prop_id -> (fingerprint, datetime)
+        changed = list()
+        for row in sorted(rows, key=lambda r: r['datetime']):
+            prop_id = row['prop_id']
+            if prop_id not in latest:
+                found = self.db.execute('SELECT fingerprint, datetime FROM fingerprints WHERE prop_id = ?',
+                                        (prop_id,)).fetchone()
+                latest[prop_id] = tuple(found) if found else (None, '')
+            last_fingerprint, last_datetime = latest[prop_id]
+            if row['datetime'] < last_datetime:
+                changed.append(row)
+                continue
+            if row['fingerprint'] != last_fingerprint:
+                changed.append(row)
+            latest[prop_id] = (row['fingerprint'], row['datetime'])
+        self.db.executemany('INSERT OR REPLACE INTO fingerprints (prop_id, fingerprint, datetime) VALUES (?, ?, ?)',
+                            [(prop_id, fp, dt) for prop_id, (fp, dt) in latest.items() if fp is not None])
+        return changed
+
+    # Look up the prop_id of each row by (address, mls_no), giving new properties the next free IDs
+    # Returns the rows for properties that aren't in the DB yet
+    def _assign_prop_ids(self, rows):
+        last_prop_id = self.db.execute('SELECT MAX(prop_id) FROM properties').fetchone()[0] or 0
+        new = dict()
+        for row in rows:
+            key = (row['address'], row.get('mls_no'))
+            if key in new:
+                row['prop_id'] = new[key]['prop_id']
+                continue
+            found = self.db.execute(
+                'SELECT prop_id FROM properties WHERE address = ? AND mls_no IS ? LIMIT 1', key).fetchone()
+            if found:
+                row['prop_id'] = found[0]
+            else:
+                last_prop_id += 1
+                row['prop_id'] = last_prop_id
+                new[key] = row
+        return list(new.values())
+
+    def _insert_properties(self, rows):
+        for row in rows:
+            row['last_update'] = row['datetime']
+            row['postal_city'] = self.postals.get(row['postal'])
+            row['peninsula'] = PENINSULA_CODES.get(row['postal_first'])
+            row['loc_bin'] = loc_bin(row['postal_first'], row['postal_city'])
+        cols = [col for col in self.property_cols if any(col in row for row in rows)]
+        if not cols:
+            return
+        query = 'INSERT INTO properties ({cols}) SELECT {params} WHERE NOT EXISTS ' \
+                '(SELECT 1 FROM properties WHERE prop_id = ?)'
+        query = query.format(cols=', '.join(cols), params=', '.join('?' * len(cols)))
+        self.db.executemany(query, [[row.get(col) for col in cols] + [row['prop_id']] for row in rows])
+
+    def _insert_updates(self, rows):
+        rows = [row for row in rows if row.get('update_id') is not None]
+        query = 'INSERT INTO updates ({cols}) SELECT {params} WHERE NOT EXISTS ' \
+                '(SELECT 1 FROM updates WHERE update_id = ?)'
+        query = query.format(cols=', '.join(self.update_cols), params=', '.join('?' * len(self.update_cols)))
+        before = self.db.total_changes
+        self.db.executemany(query, [[row.get(col) for col in self.update_cols] + [row['update_id']]
+                                    for row in rows])
+        return self.db.total_changes - before
+
+    # Ingest a whole file of scraped records (see writer.py), returns how many records were in it
+    def ingest_file(self, path, batch_size=5000):
+        n = 0
+        batch = list()
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                if line.strip():
+                    batch.append(json.loads(line))
+                if len(batch) >= batch_size:
+                    n += self._ingest_batch(batch, path)
+                    batch = list()
+        return n + self._ingest_batch(batch, path)
+
+    def _ingest_batch(self, records, path):
+        with self._lock:
+            self._flush()
+            self._buffer = [(record, path) for record in records]
+            self._flush()
+        return len(records)
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self.db.close()
+
+
+# Load scraped files into the listings DB without going through R, e.g. `python ingest.py data/listings_*.jsonl`
+# With --mark-done the files are renamed to .done afterwards, so 03-cleanup-scraped.R skips them
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    import os
+    import time
+
+    parser = ArgumentParser()
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--db', default='data/listings.db')
+    parser.add_argument('--mark-done', action='store_true')
+    # --geocode adds the new properties to the 'geocode' table afterwards, see geocode.py
+    parser.add_argument('--geocode', action='store_true')
+    args = parser.parse_args()
+
+    ingest = Ingestor(args.db)
+    for path in args.files:
+        start = time.perf_counter()
+        n = ingest.ingest_file(path)
+        print('{path}: {n} records in {t:.1f} secs'.format(path=path, n=n, t=time.perf_counter() - start))
+        if args.mark_done:
+            os.rename(path, os.path.splitext(path)[0] + '.done')
+    if args.geocode:
+        from geocode import Geocoder, geocode_missing
+        geocoder = Geocoder()
+        print('Geocoded {n} addresses'.format(n=geocode_missing(ingest.db, geocoder)))
+        geocoder.close()
+    ingest.close()
@@ -0,0 +1,169 @@
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+import threading
+import time
+
+# Shared by every session in the process unless they're given their own, see Metrics.shared()
+_shared = None
+_shared_lock = threading.Lock()
+
+
+'''
+Timers and counters for the hot path of the scraper
+  * timer('stage') times a block of code, and keeps the count, total and slowest time for each stage
+  * count('event') counts things like listings scraped, retries and bytes parsed
+  * failure('cause') counts failures by what went wrong
+The totals are written to 'path' as JSON, and next to it as Prometheus text (.prom), at the end of a
+run and every 'interval' seconds while it's going (see maybe_export)
+'''
+class Metrics:
+    def __init__(self, path='logs/metrics.json', interval=60):
+        self.path = path
+        self.interval = interval
+        self.started = time.monotonic()
+        self.started_at = str(datetime.now())
+        self.stages = dict()
+        self.counters = dict()
+        self.failures = dict()
+        self._lock = threading.Lock()
+        self._last_export = time.monotonic()
+
+    # The metrics shared by every session that doesn't bring its own
+    @classmethod
+    def shared(cls):
+        global _shared
+        with _shared_lock:
+            if _shared is None:
+                _shared = cls()
+            return _shared
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    # Add one timing of 'seconds' to 'stage'
+    def record(self, stage, seconds):
+        with self._lock:
+            stats = self.stages.setdefault(stage, {'count': 0, 'total': 0.0, 'max': 0.0})
+            stats['count'] += 1
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+
+    def count(self, event, n=1):
+        with self._lock:
+            self.counters[event] = self.counters.get(event, 0) + n
+
+    def failure(self, cause):
+        with self._lock:
+            self.failures[cause] = self.failures.get(cause, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = time.monotonic() - self.started
+            stages = {stage: dict(stats, mean=stats['total'] / stats['count'])
+                      for stage, stats in self.stages.items()}
+            return {
+                'started': self.started_at,
+                'updated': str(datetime.now()),
+                'elapsed_secs': elapsed,
+                'listings_per_min': self.counters.get('listings', 0) / (elapsed / 60) if elapsed else 0,
+                # What the browser downloaded per page, see Viewpoint.record_page_weight()
+                'kb_per_page': (self.counters.get('page_bytes', 0) / 1024 / self.counters['pages_weighed']
+                                if self.counters.get('pages_weighed') else None),
+                'stages': stages,
+                'counters': dict(self.counters),
+                'failures': dict(self.failures),
+            }
+
+    # One line for the log at the end of a run: throughput, the stages that took the most time, and failures
+    def summary(self, top=5):
+        snapshot = self.snapshot()
+        stages = sorted(snapshot['stages'].items(), key=lambda item: item[1]['total'], reverse=True)[:top]
+        return '{n} listings in {m:.1f} mins ({r:.2f}/min, {kb} KB/page); most time in {s}; failures: {f}'.format(
+            n=snapshot['counters'].get('listings', 0),
+            m=snapshot['elapsed_secs'] / 60,
+            r=snapshot['listings_per_min'],
+            kb='?' if snapshot['kb_per_page'] is None else '{0:.0f}'.format(snapshot['kb_per_page']),
+            s=', '.join('{0} {1:.0f}s'.format(stage, stats['total']) for stage, stats in stages) or 'nothing',
+            f=', '.join('{0} {1}'.format(cause, n) for cause, n in sorted(snapshot['failures'].items())) or 'none')
+
+    # Render a snapshot in the Prometheus text exposition format
+    def prometheus(self, snapshot=None):
+        snapshot = snapshot or self.snapshot()
+        lines = [
+            '# TYPE vistaguide_listings_per_minute gauge',
+            'vistaguide_listings_per_minute {0:.3f}'.format(snapshot['listings_per_min']),
+            '# TYPE vistaguide_stage_seconds summary',
+        ]
+        for stage, stats in sorted(snapshot['stages'].items()):
+            lines.append('vistaguide_stage_seconds_sum{{stage="{0}"}} {1:.6f}'.format(stage, stats['total']))
+            lines.append('vistaguide_stage_seconds_count{{stage="{0}"}} {1}'.format(stage, stats['count']))
+        lines.append('# TYPE vistaguide_stage_seconds_max gauge')
+        for stage, stats in sorted(snapshot['stages'].items()):
+            lines.append('vistaguide_stage_seconds_max{{stage="{0}"}} {1:.6f}'.format(stage, stats['max']))
+        lines.append('# TYPE vistaguide_events_total counter')
+        for event, n in sorted(snapshot['counters'].items()):
+            lines.append('vistaguide_events_total{{event="{0}"}} {1}'.format(event, n))
+        lines.append('# TYPE vistaguide_failures_total counter')
+        for cause, n in sorted(snapshot['failures'].items()):
+            lines.append('vistaguide_failures_total{{cause="{0}"}} {1}'.format(cause, n))
+        return '\n'.join(lines) + '\n'
+
+    # Write the metrics out as JSON to 'path', and as Prometheus text to the same path ending in .prom
+    def export(self):
+        self._last_export = time.monotonic()
+        snapshot = self.snapshot()
+        _write_atomic(self.path, json.dumps(snapshot, indent=2))
+        _write_atomic(os.path.splitext(self.path)[0] + '.prom', self.prometheus(snapshot))
+
+    # Export if it's been more than 'interval' seconds since the last time
+    def maybe_export(self):
+        if time.monotonic() - self._last_export >= self.interval:
+            self.export()
+
+
+# Write to a temporary file and swap it in, so whatever is reading the metrics never sees half a file
+def _write_atomic(path, text):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as file:
+        file.write(text)
+    os.replace(tmp, path)
+
+
+# Total resident memory in MB of the process 'pid' and all of its children (i.e., every Chrome process)
+# Returns None if it can't be measured, which is the case anywhere without /proc
+def process_tree_rss(pid):
+    children = dict()
+    rss = dict()
+    page_mb = os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    try:
+        procs = [p for p in os.listdir('/proc') if p.isdigit()]
+    except FileNotFoundError:
+        return None
+    for proc in procs:
+        try:
+            with open('/proc/{0}/stat'.format(proc)) as file:
+                stat = file.read()
+            with open('/proc/{0}/statm'.format(proc)) as file:
+                rss[int(proc)] = int(file.read().split()[1]) * page_mb
+        except (FileNotFoundError, ProcessLookupError, PermissionError, IndexError):
+            continue
+        # The command name can have spaces in it, so the parent PID is counted from the closing bracket
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(ppid, list()).append(int(proc))
+
+    if pid not in rss:
+        return None
+    total = 0
+    todo = [pid]
+    while todo:
+        proc = todo.pop()
+        total += rss.get(proc, 0)
+        todo.extend(children.get(proc, list()))
+    return total
@@ -0,0 +1,185 @@
+from selenium.common import exceptions as sce
+from datetime import datetime
+import queue
+import threading
+import time
+import viewpoint as vp
+from retries import take_due
+from urlstore import UrlStore
+
+# Handed to each worker through the queue to tell it there's no more work
+_STOP = None
+
+
+# Caps the combined request rate of every session that shares it
+# Each call to wait() reserves the next free slot, then sleeps until that slot comes up
+class RateLimiter:
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+'''
+A pool of logged-in Viewpoint sessions that scrape an index together
+The coordinator session paginates through the index and puts the listing URLs on a queue,
+and each worker session takes URLs off of the queue and scrapes them with Viewpoint.scrape_url()
+Every session writes to the same out_path and fail_path, see writer.RecordWriter and viewpoint.append_line()
+'''
+class ViewpointPool:
+    def __init__(self, username, password, workers=4, max_rate=None, headless=True,
+                 out_path=None,
+                 fail_path=None,
+                 url_store=None,
+                 ingest=None,
+                 archive=None,
+                 retries=None,
+                 retry_batch=0,
+                 fetch_profile='full'):
+
+        # Every session in the pool shares the same output files and rate limit
+        if not out_path:
+            out_path = vp.next_filename("data/listings_")
+        if not fail_path:
+            fail_path = 'logs/failed/{dt}.log'.format(dt=datetime.now().strftime('%Y%m%d'))
+        self.throttle = RateLimiter(max_rate) if max_rate else None
+        self.urls = url_store if url_store is not None else UrlStore()
+
+        session_args = dict(username=username, password=password, headless=headless,
+                            out_path=out_path, fail_path=fail_path, throttle=self.throttle,
+                            url_store=self.urls, ingest=ingest, archive=archive, retries=retries,
+                            fetch_profile=fetch_profile)
+
+        self.coordinator = vp.Viewpoint(**session_args)
+        self.logger = self.coordinator.logger
+        self.out_path = out_path
+        self.fail_path = fail_path
+        # With a retry queue, up to 'retry_batch' earlier failures that are due go to the workers after each page
+        self.retries = retries
+        self.retry_batch = retry_batch
+
+        self.workers = list()
+        for i in range(workers):
+            self.logger.debug('Starting worker session #{n}'.format(n=i + 1))
+            self.workers.append(vp.Viewpoint(**session_args))
+        self.logger.info('Started a pool of {n} worker sessions'.format(n=len(self.workers)))
+
+        self.queue = queue.Queue(maxsize=4 * len(self.workers))
+        self.seen = set()  # URLs that have already been put on the queue
+        self.checkpoint = None
+        self.incremental = None
+
+    # Paginate through the index the coordinator is focused on, and scrape every listing with the workers
+    # With a 'checkpoint', the pages and the listings the workers finish are recorded to it
+    # 'incremental' works like it does for Viewpoint.scrape_index()
+    def scrape_index(self, checkpoint=None, incremental=None):
+        self.checkpoint = checkpoint
+        self.incremental = incremental
+        threads = [threading.Thread(target=self._work, args=(worker,), daemon=True)
+                   for worker in self.workers]
+        for thread in threads:
+            thread.start()
+
+        try:
+            self._paginate()
+        finally:
+            # Always let the workers finish what's on the queue and exit
+            for _ in threads:
+                self.queue.put(_STOP)
+            for thread in threads:
+                thread.join()
+        self.logger.info('Pool finished scraping the index')
+
+    def _paginate(self):
+        session = self.coordinator
+        session.index_window = session.current_window_handle
+        current_page = self.checkpoint.page if self.checkpoint else 1
+        if self.incremental:
+            self.urls.start_crawl(self.incremental, resumed=self.checkpoint.processed if self.checkpoint else ())
+        previous = None
+        while True:
+            # Wait for the links to change from the last page, to prevent duplicates
+            listings = session.wait_for(vp.index_loaded(previous), message='index links') or session.index_listings()
+            previous = [href for _, href in listings]
+            urls = session.listing_urls(listings)
+
+            # If there's no links found, it's probably a bug, reload the page and try again
+            retry = 0
+            while len(urls) == 0 and retry < 2:
+                retry += 1
+                self.logger.warning("No links found on page {p}".format(p=current_page))
+                session.polite_pause()
+                session.refresh()
+                urls = session.listing_urls(session.wait_for(vp.index_loaded(), timeout=60) or list())
+
+            caught_up = False
+            if self.incremental:
+                if current_page == 1 and urls:
+                    self.urls.note_newest(self.incremental, urls[0])
+                caught_up = self.urls.caught_up(self.incremental, urls)
+
+            if self.checkpoint:
+                self.checkpoint.start_page(current_page, session.current_url)
+                self.seen.update(self.checkpoint.processed)
+
+            new_urls = [url for url in urls if url not in self.seen and url not in self.urls.worked]
+            self.logger.info('Queueing {n} of {m} links on page {p}'.format(n=len(new_urls),
+                                                                           m=len(urls),
+                                                                           p=current_page))
+            for url in new_urls:
+                self.seen.add(url)
+                self.queue.put(url)
+            if self.retries is not None and self.retry_batch:
+                for url in take_due(session, self.retries, self.retry_batch):
+                    self.queue.put(url)
+
+            if caught_up:
+                self.logger.info('Caught up with the last crawl on page {p}, stopping'.format(p=current_page))
+                break
+
+            next_button = session.next_button()
+            if not next_button:
+                self.logger.info('All finished after page ' + str(current_page))
+                break
+            session.pace()
+            next_button.click()
+            current_page += 1
+            self.logger.debug('Switching to page {page}'.format(page=current_page))
+
+    # Worker loop: scrape URLs off the queue until told to stop
+    def _work(self, session):
+        # Workers only ever keep their main window, so that's what gets left after a cleanup
+        session.index_window = session.current_window_handle
+        while True:
+            url = self.queue.get()
+            try:
+                if url is _STOP:
+                    return
+                try:
+                    with session.metrics.timer('listing'):
+                        session.scrape_url(url)
+                    session.metrics.maybe_export()
+                except sce.WebDriverException:
+                    session.logger.warning('Worker failed to scrape ' + url)
+                    session.record_failure(url, reason='webdriver_error')
+                    session.close_leftover_windows()
+                if self.checkpoint:
+                    self.checkpoint.done(url)
+            finally:
+                self.queue.task_done()
+
+    # Close every session in the pool
+    def quit(self):
+        for session in self.workers + [self.coordinator]:
+            try:
+                session.quit()
+            except sce.WebDriverException:
+                pass
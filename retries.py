@@ -0,0 +1,207 @@
+from selenium.common import exceptions as sce
+from datetime import datetime, timedelta
+import glob
+import logging
+import os
+import sqlite3
+import threading
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS retries (
+    url TEXT PRIMARY KEY,
+    reason TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    next_try TEXT NOT NULL,
+    first_failed TEXT NOT NULL,
+    last_failed TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS retries_due ON retries (status, priority, next_try);
+'''
+
+# Why a listing failed (see Viewpoint.record_failure), mapped to (priority, max attempts)
+# A lower priority is retried first. Pages that came up blank or windows that didn't open usually work the
+# next time, a listing without a print button has often been taken down, so it gets fewer tries
+REASONS = {
+    'blank_title': (0, 6),
+    'window_not_opened': (1, 6),
+    'webdriver_error': (1, 6),
+    'tab_closed': (1, 6),
+    'no_print_button': (2, 3),
+    'unknown': (2, 4),
+}
+
+
+'''
+A persistent queue of listing URLs to try again, in an SQLite file that outlives the day's failure log
+Each failure pushes the URL back with its reason. It's retried after an exponential backoff
+(base_delay, doubling with every attempt up to max_delay), and given up on after the reason's max
+attempts. due() hands out the URLs that are ready, highest priority first, and leases them for
+'lease' so another worker draining the same queue doesn't take them too. A leased URL that's scraped
+is taken off the queue by Viewpoint.mark_if_read(), through done()
+'''
+class RetryQueue:
+    def __init__(self, path='data/retries.db', base_delay=timedelta(minutes=15), max_delay=timedelta(days=1),
+                 lease=timedelta(minutes=30)):
+        self.logger = logging.getLogger('viewpointer')
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease = lease
+        self._lock = threading.Lock()
+        self.leased = set()  # URLs handed out by due() that haven't worked or failed again yet
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.db.executescript(_SCHEMA)
+        self.db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self.db.execute('SELECT COUNT(*) FROM retries WHERE status = \'waiting\'').fetchone()[0]
+
+    # How many URLs are ready to try again right now
+    def due_count(self):
+        with self._lock:
+            return self.db.execute('SELECT COUNT(*) FROM retries WHERE status = \'waiting\' AND next_try <= ?',
+                                   (str(datetime.now()),)).fetchone()[0]
+
+    # Record that 'url' failed because of 'reason', and schedule its next try
+    # Without a reason, it keeps the one it failed with last time
+    def push(self, url, reason=None):
+        now = datetime.now()
+        with self._lock:
+            row = self.db.execute('SELECT attempts, reason FROM retries WHERE url = ?', (url,)).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            reason = reason or (row[1] if row else 'unknown')
+            priority, max_attempts = REASONS.get(reason, REASONS['unknown'])
+            delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+            status = 'waiting' if attempts < max_attempts else 'gave_up'
+            self.db.execute('''
+                INSERT INTO retries (url, reason, priority, attempts, status, next_try, first_failed, last_failed)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(url) DO UPDATE SET
+                    reason = excluded.reason,
+                    priority = excluded.priority,
+                    attempts = excluded.attempts,
+                    status = excluded.status,
+                    next_try = excluded.next_try,
+                    last_failed = excluded.last_failed
+                ''', (url, reason, priority, attempts, status, str(now + delay), str(now), str(now)))
+            self.db.commit()
+            self.leased.discard(url)
+        if status == 'gave_up':
+            self.logger.warning('Giving up on {url} after {n} attempts ({r})'.format(url=url, n=attempts, r=reason))
+
+    # Up to 'limit' URLs that are due for another try, highest priority and longest waiting first
+    # They're leased, so they won't come up again until the lease runs out or they fail again
+    def due(self, limit=None):
+        now = datetime.now()
+        with self._lock:
+            urls = [row[0] for row in self.db.execute(
+                'SELECT url FROM retries WHERE status = \'waiting\' AND next_try <= ? '
+                'ORDER BY priority, next_try LIMIT ?', (str(now), -1 if limit is None else limit))]
+            self.db.executemany('UPDATE retries SET next_try = ? WHERE url = ?',
+                                [(str(now + self.lease), url) for url in urls])
+            self.db.commit()
+            self.leased.update(urls)
+        return urls
+
+    # The leased 'url' worked, so it doesn't need trying again. Anything else is left alone, so this
+    # is cheap to call for every listing that's scraped
+    def done(self, url):
+        if url not in self.leased:
+            return
+        with self._lock:
+            self.db.execute('DELETE FROM retries WHERE url = ?', (url,))
+            self.db.commit()
+            self.leased.discard(url)
+
+    # Queue the URLs in the failure logs in 'directory' that were never retried, e.g. from days the retry
+    # script didn't run, then mark the logs as done. Returns the number of URLs queued
+    def import_logs(self, directory='logs/failed'):
+        n = 0
+        today = os.path.join(directory, datetime.now().strftime('%Y%m%d') + '.log')
+        for path in sorted(glob.glob(os.path.join(directory, '*.log'))):
+            if path == today:  # Still being written to, and these failures are in the queue already
+                continue
+            with open(path, 'r') as file:
+                urls = {line.strip() for line in file if line.strip()}
+            with self._lock:
+                known = {row[0] for row in self.db.execute('SELECT url FROM retries')}
+            for url in urls - known:
+                self.push(url, 'unknown')
+                n += 1
+            with open(path + '.done', 'a') as file:
+                file.write(''.join(url + '\n' for url in sorted(urls)))
+            os.remove(path)
+        return n
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+# Up to 'limit' URLs from 'queue' that are due, ready for the Viewpoint 'session' to scrape again
+# Anything that's been scraped since it failed is taken off the queue instead
+def take_due(session, queue, limit=None):
+    urls = list()
+    for url in queue.due(limit):
+        if url in session.worked:
+            queue.done(url)
+            continue
+        # The session's failed set would skip anything that already failed this run
+        session.failed.discard(url)
+        urls.append(url)
+    return urls
+
+
+# Try the URLs in 'queue' that are due with the Viewpoint 'session', up to 'limit' of them
+# Failures are pushed back onto the queue by session.record_failure(). Returns the number that worked
+# A browser error only fails the URL it happened on. The windows it left open are closed and the rest are
+# tried in the window the session was on to begin with
+def drain(session, queue, limit=None):
+    worked = 0
+    window = session.current_window_handle
+    for url in take_due(session, queue, limit):
+        try:
+            scraped = session.scrape_url(url)
+        except sce.WebDriverException:
+            session.logger.warning('Failed to retry ' + url)
+            session.record_failure(url, reason='webdriver_error')
+            session.close_leftover_windows(keep=window)
+            continue
+        if scraped:
+            worked += 1
+        elif url not in session.failed:
+            # It wasn't scraped and nothing said why, e.g. a URL scrape_url() doesn't know how to handle
+            queue.push(url)
+    return worked
+
+
+'''
+Retries failures in between the listings of a crawl, for Viewpoint.scrape_index(after_listing=...)
+Every 'every' listings it tries up to 'batch' due URLs in a window of its own, then goes back to the index
+'''
+class InterleavedRetries:
+    def __init__(self, queue, batch=3, every=20):
+        self.queue = queue
+        self.every = every
+        self.batch = batch
+        self._listings = 0
+
+    def __call__(self, session):
+        self._listings += 1
+        if self._listings % self.every or not self.queue.due_count():
+            return
+        index = session.current_window_handle
+        before = set(session.window_handles)
+        session.execute_script('window.open("about:blank", "_blank");')
+        window = [handle for handle in session.window_handles if handle not in before][0]
+        session.switch_to.window(window)
+        try:
+            worked = drain(session, self.queue, self.batch)
+            session.logger.info('Retried failures in between listings, {n} worked'.format(n=worked))
+        finally:
+            if window in session.window_handles:
+                session.switch_to.window(window)
+                session.close()
+            session.switch_to.window(index)
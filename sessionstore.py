@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import threading
+
+
+'''
+Keeps the cookies of the last login in a JSON file, so the next Viewpoint session can skip the login form
+Every login means loading the form and posting it, and logging in too often gets the account rate-limited
+A saved session is only handed out to the same username and for 'max_age' after it was saved, and
+Viewpoint checks that it still works before relying on it (see Viewpoint.restore_session())
+The file holds live session cookies, so it's only readable by the user that wrote it
+'''
+class SessionStore:
+    def __init__(self, path='data/session.json', max_age=timedelta(hours=12)):
+        self.logger = logging.getLogger('viewpointer')
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+
+    # The saved session for 'username' as a dict with 'url' (the page the login landed on) and 'cookies'
+    # Returns None if there isn't one, it's for somebody else, or it's too old
+    def load(self, username):
+        with self._lock:
+            try:
+                with open(self.path, 'r') as file:
+                    saved = json.load(file)
+            except (FileNotFoundError, ValueError):
+                return None
+        if saved.get('username') != username:
+            return None
+        if datetime.fromisoformat(saved['saved']) < datetime.now() - self.max_age:
+            self.logger.debug('Saved session from {dt} is too old'.format(dt=saved['saved']))
+            return None
+        return saved
+
+    # Remember the 'cookies' (like driver.get_cookies() gives) of a login that landed on 'url'
+    def save(self, username, url, cookies):
+        text = json.dumps({'username': username, 'saved': datetime.now().isoformat(), 'url': url, 'cookies': cookies})
+        tmp = self.path + '.tmp'
+        with self._lock:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as file:
+                file.write(text)
+            os.replace(tmp, self.path)
+        self.logger.debug('Saved the session cookies to ' + self.path)
+
+    # Forget the saved session, e.g. once it's stopped working
+    def clear(self):
+        with self._lock:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+# A cookie from driver.get_cookies() as a CookieParam for the DevTools Network.setCookies command
+# Cookies without a leading dot only belong to their exact host, so they're set by URL to keep them that way
+def cdp_cookie(cookie):
+    param = {key: cookie[key] for key in ('name', 'value', 'path', 'secure', 'httpOnly', 'sameSite') if key in cookie}
+    domain = cookie.get('domain', '')
+    if domain.startswith('.'):
+        param['domain'] = domain
+    else:
+        param['url'] = '{s}://{d}{p}'.format(s='https' if cookie.get('secure') else 'http', d=domain,
+                                             p=cookie.get('path', '/'))
+    if 'expiry' in cookie:
+        param['expires'] = cookie['expiry']
+    return param
@@ -0,0 +1,104 @@
+from selenium.common import exceptions as sce
+import logging
+import viewpoint as vp
+from checkpoint import Checkpoint
+from metrics import process_tree_rss
+
+
+# Raised from the health check to make the supervisor restart the browser
+class RecycleSession(Exception):
+    pass
+
+
+'''
+Runs a crawl of a saved search with a Viewpoint session that gets restarted when it's worn out
+After every listing it checks how many listings the browser has done, how much memory Chrome is
+using and how many windows are open. Once any of them go over their limit (or the browser crashes),
+it quits the browser, logs in with a fresh one, and picks the crawl back up from the checkpoint
+'''
+class SupervisedSession:
+    def __init__(self, search, checkpoint=None,
+                 max_listings=200,
+                 max_rss_mb=1500,
+                 max_windows=4,
+                 max_restarts=20,
+                 **session_args):
+        self.logger = logging.getLogger('viewpointer')
+        self.search = search
+        self.session_args = session_args
+        self.checkpoint = checkpoint or Checkpoint(search=search, out_path=session_args.get('out_path'))
+        self.max_listings = max_listings
+        self.max_rss_mb = max_rss_mb
+        self.max_windows = max_windows
+        self.max_restarts = max_restarts
+        self.session = None
+        self.restarts = 0
+        self._listings = 0
+
+    # Crawl the whole saved search, restarting the browser whenever it's needed
+    # 'incremental' works like it does for Viewpoint.scrape_index(), and 'after_listing' is called with
+    # the session after every listing once its health has been checked
+    def scrape_index(self, incremental=None, after_listing=None):
+        def check(session):
+            self.check_health(session)
+            if after_listing:
+                after_listing(session)
+
+        resume = bool(self.checkpoint.page_urls)
+        while True:
+            try:
+                self.start(resume=resume)
+                self.session.scrape_index(checkpoint=self.checkpoint, after_listing=check,
+                                          incremental=incremental)
+                break
+            except RecycleSession as e:
+                self.logger.info('Recycling the browser: ' + str(e))
+            except sce.WebDriverException as e:
+                self.logger.warning('Browser failed, restarting it: ' + str(e).strip())
+            self.stop()
+            self.restarts += 1
+            if self.restarts > self.max_restarts:
+                self.logger.error('Giving up after {n} browser restarts'.format(n=self.max_restarts))
+                raise RecycleSession('Too many restarts')
+            resume = True
+        self.checkpoint.finish()
+
+    # Log in with a new browser, open the search and go back to the checkpoint's page if we're resuming
+    def start(self, resume=False):
+        self._listings = 0
+        self.session = vp.Viewpoint(**self.session_args)
+        self.session.open_saved_search(self.search)
+        if resume:
+            self.session.resume(self.checkpoint)
+
+    def stop(self):
+        if self.session is None:
+            return
+        try:
+            self.session.quit()
+        except (sce.WebDriverException, OSError):
+            pass
+        self.session = None
+
+    # Called after every listing, raises RecycleSession when the browser needs restarting
+    def check_health(self, session):
+        self._listings += 1
+        if self.max_listings and self._listings >= self.max_listings:
+            raise RecycleSession('{n} listings scraped'.format(n=self._listings))
+
+        windows = len(session.window_handles)
+        if self.max_windows and windows > self.max_windows:
+            session.close_leftover_windows()
+            windows = len(session.window_handles)
+            if windows > self.max_windows:
+                raise RecycleSession('{n} windows open'.format(n=windows))
+
+        if self.max_rss_mb:
+            rss = process_tree_rss(session.service.process.pid)
+            if rss is not None:
+                session.logger.debug('Browser is using {0:.0f} MB'.format(rss))
+                if rss > self.max_rss_mb:
+                    raise RecycleSession('browser is using {0:.0f} MB'.format(rss))
+
+    def quit(self):
+        self.stop()
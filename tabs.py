@@ -0,0 +1,330 @@
+from selenium.common import exceptions as sce
+import asyncio
+import time
+from retries import take_due
+from writer import flush_all
+
+# Handed to each tab through the queue to tell it there's no more work
+_STOP = None
+
+# Navigating with window.location returns straight away instead of blocking like driver.get()
+# The old document is flagged first, so it can't be mistaken for the new one while it's still showing
+_NAVIGATE = 'window.__vpLeaving = true; window.location.href = arguments[0];'
+
+# Readiness checks, run in the tab. Each is falsy until the new page has loaded and has what we need
+_READY = '!window.__vpLeaving && document.readyState !== "loading"'
+_CUTSHEET_READY = 'return ' + _READY + ' && document.title.length > 10 && ' \
+                                       'document.querySelectorAll("li.row").length > 0;'
+# Gives the link behind the print button, or true if the button isn't a link we can follow
+_PRINT_READY = 'var button = document.querySelector(".cutsheet-print"); ' \
+               'return ' + _READY + ' && !!button && (button.href || true);'
+_LOADED = 'return ' + _READY + ' && document.readyState === "complete";'
+
+
+'''
+Scrapes listings in K tabs of one logged-in Viewpoint session at the same time
+Instead of shift-clicking popups and waiting on each one, every tab is pointed at a listing with
+window.location and the tabs are polled for readiness with asyncio, so while one tab is loading the
+others are being read. A WebDriver session can only talk to one tab at a time, so every call to
+the browser goes through one lock and switches to its tab first; the waiting happens outside of it
+Listing pages are followed to the printable cutsheet through the print button's link. A print button
+that isn't a link is clicked in the tab, and the cutsheet is read from the window it opens
+With 'retry_batch', up to that many due failures from the session's retry queue are queued after each page
+'''
+class TabEngine:
+    # 'on_listing' is called with each URL and the seconds it took once it's done, see bench/run.py
+    def __init__(self, session, tabs=4, timeout=10, poll=0.2, on_listing=None, retry_batch=0):
+        self.session = session
+        self.retry_batch = retry_batch
+        self.on_listing = on_listing
+        self.logger = session.logger
+        self.metrics = session.metrics
+        self.tabs = tabs
+        self.timeout = timeout
+        self.poll = poll
+        self.handles = list()
+        self.checkpoint = None
+        self.incremental = None
+        self._focused = None
+        self._lock = None  # Made in the event loop, see _run()
+        self._click_lock = None
+
+    # Paginate through the index the session is focused on, and scrape every listing in the tabs
+    # With a 'checkpoint', the pages and the listings that are finished are recorded to it
+    # 'incremental' works like it does for Viewpoint.scrape_index()
+    def scrape_index(self, checkpoint=None, incremental=None):
+        self.checkpoint = checkpoint
+        self.incremental = incremental
+        self.session.index_window = self.session.current_window_handle
+        asyncio.run(self._run(self._paginate))
+        self.logger.info('Tabs finished scraping the index')
+
+    # Scrape a list of listing or cutsheet URLs in the tabs
+    def scrape_urls(self, urls):
+        async def feed(queue):
+            for url in list(dict.fromkeys(urls)):
+                await queue.put(url)
+        self.session.index_window = self.session.current_window_handle
+        asyncio.run(self._run(feed))
+
+    # Open the tabs, start a worker on each one, and have 'producer' fill their queue
+    async def _run(self, producer):
+        self._lock = asyncio.Lock()
+        self._click_lock = asyncio.Lock()
+        self._focused = self.session.current_window_handle
+        await self._open_tabs()
+        queue = asyncio.Queue(maxsize=2 * self.tabs)
+        workers = [asyncio.ensure_future(self._work(i, queue)) for i in range(len(self.handles))]
+        try:
+            await producer(queue)
+        finally:
+            for _ in workers:
+                await queue.put(_STOP)
+            await asyncio.gather(*workers)
+            await self._close_tabs()
+
+    # Run the blocking WebDriver call 'fn' on the tab 'handle', one call at a time
+    async def _call(self, handle, fn, *args):
+        async with self._lock:
+            return await asyncio.get_event_loop().run_in_executor(None, self._switch_and_call, handle, fn, args)
+
+    def _switch_and_call(self, handle, fn, args):
+        if handle is not None and handle != self._focused:
+            self.session.switch_to.window(handle)
+            self._focused = handle
+        return fn(*args)
+
+    # The page source and URL of the focused tab, once its size has been counted
+    def _read_page(self):
+        self.session.record_page_weight()
+        return self.session.page_source, self.session.current_url
+
+    # Click the print button in the focused tab, returns the windows that were open before the click
+    def _click_print(self):
+        before = self.session.window_handles
+        self.session.find_element_by_class_name('cutsheet-print').click()
+        return before
+
+    def _close_window(self):
+        try:
+            self.session.close()
+        except sce.NoSuchWindowException:
+            pass
+        self._focused = None
+
+    async def _open_tabs(self):
+        def open_tabs():
+            before = set(self.session.window_handles)
+            for _ in range(self.tabs):
+                self.session.execute_script('window.open("about:blank", "_blank");')
+            return [handle for handle in self.session.window_handles if handle not in before]
+        self.handles = await self._call(None, open_tabs)
+        self.logger.debug('Opened {n} tabs: {h}'.format(n=len(self.handles), h=self.handles))
+
+    async def _close_tabs(self):
+        def close_tabs():
+            for handle in self.handles:
+                try:
+                    self.session.switch_to.window(handle)
+                    self.session.close()
+                except sce.WebDriverException:
+                    pass
+            self.session.switch_to.window(self.session.index_window)
+            self._focused = self.session.index_window
+        await self._call(None, close_tabs)
+        self.handles = list()
+
+    # Replace tab number 'i' if it was closed or crashed
+    async def _reopen_tab(self, i):
+        def reopen():
+            self.session.switch_to.window(self.session.index_window)
+            self._focused = self.session.index_window
+            before = set(self.session.window_handles)
+            self.session.execute_script('window.open("about:blank", "_blank");')
+            return [handle for handle in self.session.window_handles if handle not in before][0]
+        self.handles[i] = await self._call(None, reopen)
+        self.logger.info('Reopened tab #{n}'.format(n=i + 1))
+
+    # Point the tab 'handle' at 'url' and wait until 'script' returns something truthy, which is returned
+    # Returns False if it's still not ready after the timeout
+    async def load(self, handle, url, script):
+        await asyncio.get_event_loop().run_in_executor(None, self.session.pace)
+        await self._call(handle, self.session.execute_script, _NAVIGATE, url)
+        return await self.wait_until(handle, script)
+
+    async def wait_until(self, handle, script, *args):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            result = await self._call(handle, self.session.execute_script, script, *args)
+            if result:
+                return result
+            if time.monotonic() > deadline:
+                return False
+            await asyncio.sleep(self.poll)
+
+    # Click the print button in the tab 'handle' and return the handle of the window it opens, or None if
+    # nothing opened before the timeout. Only one tab clicks at a time, so they can't mix up their windows
+    async def open_print_window(self, handle):
+        async with self._click_lock:
+            before = set(await self._call(handle, self._click_print))
+            deadline = time.monotonic() + self.timeout
+            while True:
+                handles = await self._call(None, lambda: self.session.window_handles)
+                opened = [window for window in handles if window not in before and window not in self.handles]
+                if opened:
+                    return opened[0]
+                if time.monotonic() > deadline:
+                    return None
+                await asyncio.sleep(self.poll)
+
+    # Worker loop for tab number 'i': scrape URLs off the queue until told to stop
+    # Nothing that goes wrong with one listing stops the worker, otherwise the queue would stop draining and
+    # the index and _run() would block on it for good
+    async def _work(self, i, queue):
+        while True:
+            url = await queue.get()
+            if url is _STOP:
+                return
+            try:
+                await self._work_on(i, url)
+            except Exception:
+                self.logger.exception('Tab #{n} failed on {url}'.format(n=i + 1, url=url))
+
+    # Scrape 'url' in tab number 'i', and record how long it took and that it's done
+    async def _work_on(self, i, url):
+        start = time.perf_counter()
+        try:
+            await self._scrape(self.handles[i], url)
+        except sce.NoSuchWindowException:
+            self.session.record_failure(url, reason='tab_closed')
+            await self._reopen_tab(i)
+        except sce.WebDriverException:
+            self.logger.warning('Tab #{n} failed to scrape {url}'.format(n=i + 1, url=url))
+            self.session.record_failure(url, reason='webdriver_error')
+        except Exception:
+            self.logger.exception('Tab #{n} failed to scrape {url}'.format(n=i + 1, url=url))
+            self.session.record_failure(url, reason='unknown')
+        elapsed = time.perf_counter() - start
+        self.metrics.record('listing', elapsed)
+        self.metrics.maybe_export()
+        if self.on_listing:
+            self.on_listing(url, elapsed)
+        if self.checkpoint:
+            self.checkpoint.done(url)
+
+    # Scrape one listing or cutsheet URL in the tab 'handle'. Returns True if the listing was written
+    async def _scrape(self, handle, url):
+        session = self.session
+        if url in session.failed or url in session.worked:
+            return False
+
+        # Each tab waits out the politeness pause on its own, without holding up the others
+        await asyncio.sleep(session.politeness)
+
+        cutsheet_url = url
+        window = handle  # Where the cutsheet is read from, the tab unless the print button opens a window
+        if 'cutsheet' not in url:
+            with self.metrics.timer('tab: print button'):
+                printable = await self.load(handle, url, _PRINT_READY)
+            if not printable:
+                session.logger.warning('No print button in tab. Skipping ' + url)
+                session.record_failure(url, reason='no_print_button')
+                return False
+            if printable is True:
+                session.logger.debug('Print button isn\'t a link, clicking it in the tab: ' + url)
+                window = await self.open_print_window(handle)
+                if window is None:
+                    session.logger.warning('Print window didn\'t open. Skipping ' + url)
+                    session.record_failure(url, reason='window_not_opened')
+                    return False
+            else:
+                cutsheet_url = printable
+
+        try:
+            with self.metrics.timer('tab: cutsheet'):
+                if window == handle:
+                    loaded = await self.load(handle, cutsheet_url, _CUTSHEET_READY)
+                else:
+                    loaded = await self.wait_until(window, _CUTSHEET_READY)
+            if not loaded:
+                # Make sure it's finished loading at least, then let read_html() decide what's wrong with it
+                await self.wait_until(window, _LOADED)
+            html, current_url = await self._call(window, self._read_page)
+        finally:
+            if window != handle:
+                await self._call(window, self._close_window)
+        if window != handle:
+            cutsheet_url = current_url
+
+        # Parse and write outside of the lock, so the other tabs can keep using the browser
+        worked = await asyncio.get_event_loop().run_in_executor(
+            None, session.read_html, html, current_url, session.out_path)
+        if worked and cutsheet_url != url:
+            session.mark_worked(cutsheet_url)
+        return session.mark_if_read(url, worked)
+
+    # Page through the index in the main window, putting the listings that haven't been done on the queue
+    async def _paginate(self, queue):
+        session = self.session
+        index = session.index_window
+        current_page = self.checkpoint.page if self.checkpoint else 1
+        seen = set(self.checkpoint.processed) if self.checkpoint else set()
+        if self.incremental:
+            session.urls.start_crawl(self.incremental, resumed=seen)
+        previous = None
+        while True:
+            # Wait for the links to change from the last page, to prevent duplicates
+            urls = await self._index_urls(previous)
+            retry = 0
+            while len(urls) == 0 and retry < 2:
+                retry += 1
+                self.metrics.count('index_retries')
+                self.logger.warning("No links found on page {p}".format(p=current_page))
+                await self._call(index, session.refresh)
+                urls = await self._index_urls()
+            previous = urls
+            self.metrics.count('pages')
+
+            caught_up = False
+            if self.incremental:
+                if current_page == 1 and urls:
+                    session.urls.note_newest(self.incremental, urls[0])
+                caught_up = session.urls.caught_up(self.incremental, urls)
+
+            if self.checkpoint:
+                flush_all()
+                self.checkpoint.start_page(current_page, await self._call(index, lambda: session.current_url))
+
+            new_urls = [url for url in urls if url not in seen and url not in session.worked]
+            self.logger.info('Queueing {n} of {m} links on page {p} for the tabs'.format(
+                n=len(new_urls), m=len(urls), p=current_page))
+            for url in new_urls:
+                seen.add(url)
+                await queue.put(url)
+            if session.retries is not None and self.retry_batch:
+                for url in take_due(session, session.retries, self.retry_batch):
+                    await queue.put(url)
+
+            if caught_up:
+                self.logger.info('Caught up with the last crawl on page {p}, stopping'.format(p=current_page))
+                break
+
+            # Not session.next_button(), that would close the tabs along with any other leftover windows
+            next_button = await self._call(index, session.find_elements_by_link_text, 'NEXT »')
+            if not next_button:
+                self.logger.info('All finished after page ' + str(current_page))
+                break
+            await asyncio.get_event_loop().run_in_executor(None, session.pace)
+            await self._call(index, next_button[0].click)
+            current_page += 1
+            self.logger.debug('Switching to page {page}'.format(page=current_page))
+
+    # The listing URLs on the index page, once they're different from 'previous'
+    async def _index_urls(self, previous=None):
+        session = self.session
+        deadline = time.monotonic() + self.timeout
+        while True:
+            urls = await self._call(session.index_window, session.listing_urls)
+            if (urls and urls != previous) or time.monotonic() > deadline:
+                return urls
+            await asyncio.sleep(self.poll)
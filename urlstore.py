@@ -0,0 +1,154 @@
+from datetime import datetime, timedelta
+import sqlite3
+import threading
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS urls (
+    url TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    first_seen TEXT NOT NULL,
+    last_seen TEXT NOT NULL,
+    fingerprint TEXT
+);
+CREATE TABLE IF NOT EXISTS crawls (
+    search TEXT PRIMARY KEY,
+    newest_url TEXT,
+    finished TEXT
+);
+'''
+
+
+'''
+Remembers every listing URL the scraper has touched, in an SQLite file shared between runs
+Each URL has a status ('worked' or 'failed'), the number of attempts, when it was first and last seen,
+and the fingerprint of what it said the last time it was scraped (see extract.fingerprint)
+The lookups that happen once per listing go through in-memory sets:
+  * worked: URLs that have been scraped successfully (within 'revisit_after', if it's set)
+  * failed: URLs that have failed since this store was opened, so a failure from a previous
+            run doesn't stop the retry script from trying it again
+It also keeps a high-water mark for incremental crawls: the newest listing at the top of each saved
+search the last time a crawl of it finished (see caught_up)
+One store can be shared by every session in a pool
+'''
+class UrlStore:
+    def __init__(self, path='data/urls.db', revisit_after=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(_SCHEMA)
+        # Stores from before fingerprints were kept don't have the column
+        if 'fingerprint' not in {row[1] for row in self.db.execute('PRAGMA table_info(urls)')}:
+            self.db.execute('ALTER TABLE urls ADD COLUMN fingerprint TEXT')
+        self.db.commit()
+
+        # Listings that worked longer ago than 'revisit_after' are fair game to scrape again
+        query = 'SELECT url FROM urls WHERE status = \'worked\''
+        params = ()
+        if revisit_after is not None:
+            if not isinstance(revisit_after, timedelta):
+                revisit_after = timedelta(days=revisit_after)
+            query += ' AND last_seen >= ?'
+            params = (str(datetime.now() - revisit_after),)
+        self.worked = {row[0] for row in self.db.execute(query, params)}
+        self.failed = set()
+        self._newest = dict()  # The top listing of each search crawled this run, saved by finish_crawl()
+        self._known = dict()  # The listings each search being crawled knew about when it started, see start_crawl()
+
+    def __len__(self):
+        return len(self.worked) + len(self.failed)
+
+    # Record that 'url' was scraped successfully
+    def mark_worked(self, url):
+        self._mark(url, 'worked')
+        self.failed.discard(url)
+        self.worked.add(url)
+
+    # Record that 'url' failed
+    def mark_failed(self, url):
+        self._mark(url, 'failed')
+        self.failed.add(url)
+
+    # Returns a dict with the stored status, attempts, first_seen and last_seen for 'url', or None
+    def lookup(self, url):
+        with self._lock:
+            row = self.db.execute('SELECT status, attempts, first_seen, last_seen FROM urls WHERE url = ?',
+                                  (url,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(['status', 'attempts', 'first_seen', 'last_seen'], row))
+
+    # The fingerprint 'url' had the last time it was scraped, or None
+    def fingerprint(self, url):
+        with self._lock:
+            row = self.db.execute('SELECT fingerprint FROM urls WHERE url = ?', (url,)).fetchone()
+        return row[0] if row else None
+
+    def set_fingerprint(self, url, fingerprint):
+        now = str(datetime.now())
+        with self._lock:
+            self.db.execute('''
+                INSERT INTO urls (url, status, attempts, first_seen, last_seen, fingerprint)
+                VALUES (?, 'worked', 0, ?, ?, ?)
+                ON CONFLICT(url) DO UPDATE SET fingerprint = excluded.fingerprint
+                ''', (url, now, now, fingerprint))
+            self.db.commit()
+
+    # The listing that was at the top of 'search' when it was last crawled all the way through, or None
+    def high_water(self, search):
+        with self._lock:
+            row = self.db.execute('SELECT newest_url FROM crawls WHERE search = ?', (search,)).fetchone()
+        return row[0] if row else None
+
+    # Remember the listing at the top of the first page of 'search', it's saved once the crawl finishes
+    def note_newest(self, search, url):
+        if url:
+            self._newest.setdefault(search, url)
+
+    # Remember which listings are already known as an incremental crawl of 'search' starts, for caught_up()
+    # Listings the crawl goes through itself don't count, and neither do the ones in 'resumed', the listings
+    # an interrupted crawl that's being resumed already went through. Calling it again for the same crawl,
+    # e.g. after a browser restart, keeps what it remembered the first time
+    def start_crawl(self, search, resumed=()):
+        if search not in self._known:
+            self._known[search] = (self.worked | self.failed) - set(resumed)
+
+    # The crawl of 'search' got to the end, so move its high-water mark up to the newest listing it saw
+    def finish_crawl(self, search):
+        self._known.pop(search, None)
+        url = self._newest.pop(search, None)
+        if url is None:
+            return
+        with self._lock:
+            self.db.execute('''
+                INSERT INTO crawls (search, newest_url, finished) VALUES (?, ?, ?)
+                ON CONFLICT(search) DO UPDATE SET newest_url = excluded.newest_url, finished = excluded.finished
+                ''', (search, url, str(datetime.now())))
+            self.db.commit()
+
+    # Whether an incremental crawl of 'search' can stop after the index page with the listing URLs 'urls'
+    # The saved searches list the newest listings first, so everything after the last crawl's newest listing,
+    # or after a page of listings that were known before the crawl started, was there last time
+    def caught_up(self, search, urls):
+        mark = self.high_water(search)
+        if mark and mark in urls:
+            return True
+        self.start_crawl(search)
+        known = self._known[search]
+        return bool(urls) and all(url in known for url in urls)
+
+    def _mark(self, url, status):
+        now = str(datetime.now())
+        with self._lock:
+            self.db.execute('''
+                INSERT INTO urls (url, status, attempts, first_seen, last_seen) VALUES (?, ?, 1, ?, ?)
+                ON CONFLICT(url) DO UPDATE SET
+                    status = excluded.status,
+                    attempts = attempts + 1,
+                    last_seen = excluded.last_seen
+                ''', (url, status, now, now))
+            self.db.commit()
+
+    def close(self):
+        with self._lock:
+            self.db.close()
@@ -3,27 +3,87 @@ from selenium.common import exceptions as sce
 from datetime import datetime
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.action_chains import ActionChains
-from selenium.webdriver.firefox.options import Options as ff_Options
+from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.chrome.options import Options as ch_Options
 from bs4 import BeautifulSoup
-import re
+from cutsheet import parse_cutsheet, is_valid, to_record
+from fetch import CutsheetFetcher
+from urlstore import UrlStore
+from sessionstore import SessionStore, cdp_cookie
+from writer import RecordWriter, flush_all, next_filename
+from extract import fingerprint
+from metrics import Metrics
 import time
-import os
 import logging
+import threading
+from collections import Counter
 from logging.handlers import TimedRotatingFileHandler
-from numpy.random import normal as rand_norm
 
-# Finds the next unused filename with the format baseYYYMMDDI.csv
-# e.g., listing-202004051.csv for the second output of April 5, 2020
-def next_filename(base: chr = 'listing_') -> chr:
-    i = 0
-    path_csv = '{base}{dt}{i}.csv'.format(base=base, dt=datetime.now().strftime('%Y%m%d'), i=i)
-    path_done = '{base}{dt}{i}.done'.format(base=base, dt=datetime.now().strftime('%Y%m%d'), i=i) 
-    while os.path.exists(path_csv) or os.path.exists(path_done):
-        i += 1
-        path_csv = '{base}{dt}{i}.csv'.format(base=base, dt=datetime.now().strftime('%Y%m%d'), i=i)
-        path_done = '{base}{dt}{i}.done'.format(base=base, dt=datetime.now().strftime('%Y%m%d'), i=i)
-    return path_csv
+# Where sessions log in, the benchmarks point this at a local copy of the site instead, see bench/
+LOGIN_URL = 'https://www.viewpoint.ca/user/login#!/new-today-list/'
+
+# Third-party hosts the 'lean' fetch profile never talks to: analytics, ads, web fonts and video players
+# Each one is blocked along with all of its subdomains
+BLOCKED_HOSTS = [
+    'google-analytics.com', 'googletagmanager.com', 'doubleclick.net', 'googlesyndication.com',
+    'googleadservices.com', 'adsrvr.org', 'facebook.net', 'facebook.com', 'hotjar.com', 'bing.com',
+    'fonts.googleapis.com', 'fonts.gstatic.com', 'youtube.com', 'ytimg.com', 'vimeo.com', 'matterport.com',
+]
+
+# What the browser downloads, see Viewpoint(fetch_profile=...)
+# 'full' is an ordinary browser. 'lean' leaves out everything read_printable() doesn't need (images, web
+# fonts, autoplaying media and the BLOCKED_HOSTS) and hands pages over as soon as their HTML is parsed,
+# since the conditions in wait_for() do the actual waiting
+FETCH_PROFILES = {
+    'full': dict(images=True, fonts=True, media=True, blocked_hosts=(), page_load='normal'),
+    'lean': dict(images=False, fonts=False, media=False, blocked_hosts=BLOCKED_HOSTS, page_load='eager'),
+}
+
+# Sums up the bytes transferred for the focused page and everything it loaded, and its load time in ms
+# Cross-origin resources only report their size if they allow it, so it's a lower bound
+_PAGE_WEIGHT = '''
+var nav = performance.getEntriesByType('navigation')[0];
+var resources = performance.getEntriesByType('resource');
+var bytes = nav ? nav.transferSize : 0;
+for (var i = 0; i < resources.length; i++) { bytes += resources[i].transferSize || 0; }
+return [bytes, resources.length, nav ? nav.domContentLoadedEventEnd - nav.startTime : 0];
+'''
+
+
+# Set up 'options' (ChromeOptions) for the fetch profile 'name' in FETCH_PROFILES
+# These are browser-wide, unlike DevTools request blocking, so they cover every popup and tab too
+def apply_fetch_profile(options, name):
+    profile = FETCH_PROFILES[name]
+    if not profile['images']:
+        options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+        options.add_argument('--blink-settings=imagesEnabled=false')
+    if not profile['fonts']:
+        options.add_argument('--disable-remote-fonts')
+    if not profile['media']:
+        options.add_argument('--autoplay-policy=user-gesture-required')
+    if profile['blocked_hosts']:
+        rules = ['MAP {h} ~NOTFOUND, MAP *.{h} ~NOTFOUND'.format(h=host) for host in profile['blocked_hosts']]
+        options.add_argument('--host-resolver-rules=' + ', '.join(rules))
+    options.set_capability('pageLoadStrategy', profile['page_load'])
+    return options
+
+
+# Serializes appends to the failure files, so rows from
+# several Viewpoint sessions running in threads never interleave
+_write_lock = threading.Lock()
+
+
+# A normally distributed random number, numpy is only imported the first time one is needed
+def rand_norm(loc=0.0, scale=1.0):
+    from numpy.random import normal
+    return normal(loc=loc, scale=scale)
+
+
+# Append one complete line of text to the file at 'path'
+def append_line(path, text):
+    with _write_lock:
+        with open(path, 'a') as file:
+            file.write(text)
 
 
 class Viewpoint(webdriver.Chrome):
@@ -32,7 +92,20 @@ class Viewpoint(webdriver.Chrome):
     def __init__(self, username, password, headless=True,
                  log='logs/viewpointer.log',
                  out_path=None,
-                 fail_path=None):
+                 fail_path=None,
+                 throttle=None,
+                 direct_fetch=False,
+                 url_store=None,
+                 politeness=1.0,
+                 jitter=1.0,
+                 implicit_wait=0,
+                 ingest=None,
+                 metrics=None,
+                 login_url=LOGIN_URL,
+                 archive=None,
+                 retries=None,
+                 session_store=None,
+                 fetch_profile='full'):
 
         # Setup the logger
         self.logger = logging.getLogger('viewpointer')
@@ -41,32 +114,25 @@ class Viewpoint(webdriver.Chrome):
         # Write a log file for everything DEBUG and up
         self.logger.setLevel(logging.DEBUG)
 
-        # Rotate the log files at midnight, keep a week's worth of logging
-        fh = TimedRotatingFileHandler(filename=log, when='midnight', backupCount=2)
-        fh.setFormatter(formatter)
-        self.logger.addHandler(fh)
+        # Only attach the handlers once, otherwise every session in a pool logs each line again
+        if not self.logger.handlers:
+            # Rotate the log files at midnight, keep a week's worth of logging
+            fh = TimedRotatingFileHandler(filename=log, when='midnight', backupCount=2)
+            fh.setFormatter(formatter)
+            self.logger.addHandler(fh)
 
-        # For console output, only print WARNING and up
-        ch = logging.StreamHandler()
-        ch.setFormatter(formatter)
-        ch.setLevel(logging.WARNING)
-        self.logger.addHandler(ch)
+            # For console output, only print WARNING and up
+            ch = logging.StreamHandler()
+            ch.setFormatter(formatter)
+            ch.setLevel(logging.WARNING)
+            self.logger.addHandler(ch)
 
         self.logger.debug('Initializing Viewpointer session')
         self.logger.info('Logging to ' + str(log))
 
-        # Set a Firefox profile so the print window doesn't mess things up
-        # I'm not sure if this is necessary in headless mode but it doesn't break it so whatever
-        profile = webdriver.FirefoxProfile()
-        profile.set_preference("print.always_print_silent", True)
-        profile.set_preference("print.show_print_progress", False)
-        self.logger.debug('Starting up Dr')
-
         # Run browser headless so it can hide in the background and not steal focus
-        gecko_options = ff_Options()
         chrome_options = ch_Options()
         if headless:
-            gecko_options.headless = True
             chrome_options.add_argument("--headless")
             chrome_options.add_argument("--no-sandbox")
             chrome_options.add_argument("--disable-extensions")
@@ -75,6 +141,10 @@ class Viewpoint(webdriver.Chrome):
         else:
             self.logger.debug('Not running headless')
 
+        # Skip the parts of each page that aren't scraped, see FETCH_PROFILES
+        apply_fetch_profile(chrome_options, fetch_profile)
+        self.logger.debug('Using the \'{0}\' fetch profile'.format(fetch_profile))
+
         if not out_path:
             self.out_path = next_filename("data/listings_")
         else:
@@ -85,34 +155,53 @@ class Viewpoint(webdriver.Chrome):
             self.fail_path = 'logs/failed/{dt}.log'.format(dt=datetime.now().strftime('%Y%m%d'))
         else:
             self.fail_path = fail_path
-        self.logger.info("Recording failures to " + self.fail_path)
+        # Failures go on a persistent retry queue if there is one, otherwise to the day's log, see retries.py
+        self.retries = retries
+        self.logger.info("Recording failures to " + ('the retry queue' if retries is not None else self.fail_path))
+
+        # Optional rate limiter shared between sessions, see pool.RateLimiter
+        self.throttle = throttle
+
+        # Pages are waited on with conditions (see wait_for), but every listing still pauses for at least
+        # 'politeness' seconds plus a normally distributed 'jitter' so we don't hammer the site
+        self.politeness = politeness
+        self.jitter = jitter
+
+        # Optionally stream every record into the listings DB as it's scraped, see ingest.py
+        self.ingest = ingest
+
+        # Optionally keep the raw HTML of every cutsheet so it can be parsed again later, see archive.py
+        self.archive = archive
+
+        # Per-stage timers and counters, shared by every session unless it's given its own, see metrics.py
+        self.metrics = metrics if metrics is not None else Metrics.shared()
 
-        _LOGIN_URL = 'https://www.viewpoint.ca/user/login#!/new-today-list/'
         # Init the webdriver with the options defined above
         super().__init__("chromedriver", options=chrome_options)
 
-        self.failed = list()  # URLs that have failed
-        self.worked = list()  # URLs that have worked
+        # Listing URLs that have worked or failed are remembered between runs, see urlstore.py
+        # self.failed and self.worked are the store's in-memory sets, so checking them is cheap
+        self.urls = url_store if url_store is not None else UrlStore()
+        self.failed = self.urls.failed  # URLs that have failed
+        self.worked = self.urls.worked  # URLs that have worked
         self.index_window = None  # The window handle of the "index" window with all the listings
+        self.opened_urls = list()  # The URLs of the listing navigate_to_printable() last opened
 
         # Set the window larger so everything stays on screen
         self.set_window_position(0, 0)
         self.set_window_size(1920, 1080)
         self.logger.debug('Changed window size')
-        self.implicitly_wait(5)
-
-        # Open the login URL and log in
-        self.logger.debug('Opening Viewpoint login URL: ' + str(_LOGIN_URL))
-        self.get(_LOGIN_URL)
-        self.implicitly_wait(2)
-
-        # Fill in username and password and click on the button
-        self.logger.info('Logging in with username \'{0}\''.format(username))
-        self.find_element_by_name('email').send_keys(username)
-        self.find_element_by_name('password').send_keys(password)
-        self.find_element_by_class_name('big').click()
-        self.implicitly_wait(5)
-        self.logger.debug('Successfully logged in')
+
+        # Set the implicit wait once, the explicit conditions in wait_for() do the actual waiting
+        self.implicitly_wait(implicit_wait)
+
+        # Reuse the cookies from the last login while they still work, otherwise log in with the form
+        self.sessions = session_store if session_store is not None else SessionStore()
+        if not self.restore_session(username):
+            self.login(username, password, login_url)
+
+        # Optionally fetch cutsheets over plain HTTP with this session's cookies, see fetch.py
+        self.fetcher = CutsheetFetcher.from_driver(self) if direct_fetch else None
 
     def __str__(self):
         # Print the window title
@@ -123,20 +212,21 @@ class Viewpoint(webdriver.Chrome):
     It then clicks on the 'print' button, closes the original popup, and changes focus to the print window
     The print window is much easier to scrape than the 'pretty' version that pops up originally
     '''
-    def navigate_to_printable(self, button):
+    def navigate_to_printable(self, button, href=None):
 
         self.logger.debug('Navigating to printable property screen')
-        self.implicitly_wait(5)
 
         # Remember which window is focused at the start
         self.index_window = self.current_window_handle
         self.logger.debug('Remembering index window: ' + str(self.index_window))
 
         # Shift click in the button to open it in a new window
-        self.logger.debug('Handles before Shift+Click: ' + str(self.window_handles))
-        ActionChains(self).key_down(Keys.SHIFT).click(button).key_up(Keys.SHIFT).perform()
-        self.logger.debug('Handles after Shift+Click: ' + str(self.window_handles))
-        self.explicitly_wait(2)
+        handles = self.window_handles
+        self.logger.debug('Handles before Shift+Click: ' + str(handles))
+        self.pace()
+        with self.metrics.timer('popup'):
+            ActionChains(self).key_down(Keys.SHIFT).click(button).key_up(Keys.SHIFT).perform()
+            self.wait_for(window_count_changed(len(handles)), message='popup window')
 
         # Check if a new window opened up
         self.logger.debug("Checking for new popup window...")
@@ -146,118 +236,147 @@ class Viewpoint(webdriver.Chrome):
             self.logger.debug('Found new window: ' + str(new_window))
             self.switch_to.window(new_window[0])
             self.log_windows()
-            self.implicitly_wait(5)
             popup_url = self.current_url
         else:
             self.logger.warning('No popup window detected')
+            self.metrics.failure('no_popup')
             self.log_windows()
             return False
 
         # If it's failed previously, skip it
         if self.current_url in self.failed:
             self.logger.info('URL already failed. Skipping ' + self.current_url)
-            self.implicitly_wait(5)
             return False
 
         # If it's already been scraped today, skip it
         if self.current_url in self.worked:
             self.logger.info('URL already scraped. Skipping ' + self.current_url)
-            self.implicitly_wait(5)
             return False
 
         # Click on the print button and close the pretty window
         self.logger.debug('Looking for a print button...')
+        print_start = time.perf_counter()
+        self.wait_for(print_button, message='print button')
+        self.record_page_weight()
         try:
             self.find_element_by_class_name('cutsheet-print').click()
             self.logger.debug('Detected a print button and clicked.')
         except sce.NoSuchElementException:
             self.logger.warning('No print button detected. Skipping ' + self.current_url)
-            self.record_failure(self.current_url)
+            self.record_failure(self.current_url, reason='no_print_button')
+            self.close_pretty_window()
             return False
-        finally:
-            self.logger.debug('Closing pretty window {0}: {1}'.format(self.current_window_handle, self.current_url))
-            try:
-                self.close()
-            except sce.NoSuchWindowException:
-                pass
-            self.explicitly_wait(2)
+        self.close_pretty_window()
+        # Only wait for the print window once the button's been clicked, otherwise it's never coming
+        self.wait_for(window_other_than(self.index_window), message='print window')
 
         # Switch context to the printable page
         try:
             new_window = list({x for x in self.window_handles} - {self.index_window})[0]
             self.switch_to.window(new_window)
+            self.wait_for(cutsheet_loaded, message='cutsheet')
+            self.metrics.record('print_window', time.perf_counter() - print_start)
             self.logger.debug('Focused on print window {0}: {1}'.format(self.current_window_handle, self.current_url))
-            self.implicitly_wait(5)
-            self.worked.append(popup_url)
+            # Marked as worked once the listing's been read, along with the link from the index,
+            # which is what gets checked before clicking
+            self.opened_urls = [popup_url] + ([href] if href and href != popup_url else [])
             return True
         except (IndexError, sce.WebDriverException):
             self.logger.warning('Couldn\'t open window. Skipping ' + self.current_url)
-            self.implicitly_wait(5)
-            self.record_failure(self.current_url)
+            self.record_failure(self.current_url, reason='window_not_opened')
             self.logger.debug('Closing window {0}: {1}'.format(self.current_window_handle, self.current_url))
             self.close()
             return False
 
+    # Close the focused 'pretty' listing window, if it's still open
+    def close_pretty_window(self):
+        self.logger.debug('Closing pretty window {0}: {1}'.format(self.current_window_handle, self.current_url))
+        try:
+            self.close()
+        except sce.NoSuchWindowException:
+            pass
+
     '''
     This is the function that does all of the scraping and writes it to the path in 'out'
     It should be called on a Selenium driver that is currently focused on a the "Print"
     view of a listing. The print view is much easier to scrape than the initial view
     '''
 
-    def read_printable(self, out='data/listings.csv'):
+    def read_printable(self, out='data/listings.jsonl'):
+        self.record_page_weight()
+        with self.metrics.timer('page_source'):
+            html = self.page_source
+        return self.read_html(html, self.current_url, out=out)
+
+    # Parse the HTML of a printable cutsheet that was loaded from 'url' and write it to the path in 'out'
+    # The HTML can come from the browser (see read_printable) or straight over HTTP (see fetch.py)
+    # Returns True if the listing was written
+    def read_html(self, html, url, out='data/listings.jsonl'):
 
         # If it's already failed, don't bother trying it
-        if self.current_url in self.failed:
-            self.logger.info('URL has already failed. Skipping ' + self.current_url)
-            self.implicitly_wait(2)
+        if url in self.failed:
+            self.logger.info('URL has already failed. Skipping ' + url)
             return None
 
-        # Run the listing page source through beautiful soup
-        listing = BeautifulSoup(self.page_source, 'html.parser')
-
-        # Take "ViewPoint.ca" out of the title
-        try:
-            title = re.sub(' - ViewPoint.ca', '', listing.title.text).strip()
-        except AttributeError:
-            title = ""
+        # The archived page gets the same timestamp as the record, so replaying it gives the same update_id
+        scraped = str(datetime.now())
+        if self.archive is not None:
+            with self.metrics.timer('archive'):
+                self.archive.add(html, url, scraped)
+
+        # Pull the title, description and data table out of the page, see cutsheet.py
+        with self.metrics.timer('parse'):
+            listing = parse_cutsheet(html)
+        self.metrics.count('bytes_parsed', len(html))
+        title = listing.title
+        if not title:
             self.logger.warning('No page title found')
 
         # Sometimes the cutsheets aren't served properly, if that happens, bail
-        if len(title) <= 10 or title == 'about:blank':
+        if not is_valid(listing):
             wait_msg = '<{title}>: Address failed to load. Skipping {url}'
-            self.logger.warning(wait_msg.format(title=title, url=self.current_url))
-            self.implicitly_wait(5)
-            self.record_failure(self.current_url)
+            self.logger.warning(wait_msg.format(title=title, url=url))
+            self.record_failure(url, reason='blank_title')
             return None
+
+        # If nothing on the cutsheet has changed since the last time, there's nothing new to write
+        # It still counts as read, so it's marked as worked
+        snapshot = fingerprint(listing.title, listing.description, listing.rows)
+        if self.urls.fingerprint(url) == snapshot:
+            self.logger.info('No changes to <{prop}> since it was last scraped'.format(prop=title))
+            self.metrics.count('unchanged')
+            return True
+
         self.logger.info('Scraping <{prop}>...'.format(prop=title))
-        try:
-            desc = listing.find("div", {"class": "row-fluid printsmall"}).text.strip()
-        except AttributeError:
-            desc = "Missing description"
+        if listing.description is None:
             self.logger.warning('Missing description for <{0}>'.format(title))
 
         # Record the time and the title of the window (which contains address and postal code)
-        listing_row = [str(datetime.now()), title, self.current_url, desc]
-
-        # Get the data table and write it to an ugly list
-        for i, line in enumerate(listing.find_all('li', {'class': 'row'})):
-            lines = ' '.join(list(str(line.text).split()))
-            listing_row.append(lines)
-        listing_row.append('\n')  # Add newline at the end to meet CSV criteria
-
-        # Append the list to the output file 'out'
-        with open(out, 'a') as file:
-            tsv = '\t'.join(listing_row)
-            file.write(tsv)
+        record = to_record(listing, url, scraped)
+
+        # Write the record to the output file 'out', see writer.py
+        with self.metrics.timer('write'):
+            RecordWriter.open(out).write(record)
+            if self.ingest is not None:
+                self.ingest.add(record, source_file=out)
+        # Saved once the record's on disk, otherwise a crash would make the next run think it's unchanged
+        RecordWriter.open(out).after_flush(lambda: self.urls.set_fingerprint(url, snapshot))
+        self.metrics.count('listings')
         self.logger.debug('Successfully scraped <{0}>'.format(title))
-        self.implicitly_wait(5)
+        return True
 
     # This function goes through the listings in an index and scrapes them all and writes to the path in 'out'
     # The first argument (driver) should be a Selenium driver that is currently focused on the index
     # of a search or a dashboard. Pagination is handled in here as well.
-    def scrape_index(self, handle=None):
+    # If there's a 'checkpoint' (see checkpoint.py), progress is recorded to it after every page and listing
+    # When resuming, call resume() first so the session is on the checkpoint's page
+    # 'after_listing' is called with the session after every listing, see supervisor.py
+    # With 'incremental' set to the name of the saved search, it stops after the first page that only has
+    # listings from previous crawls (see UrlStore.caught_up), call self.urls.finish_crawl() once it's done
+    def scrape_index(self, handle=None, checkpoint=None, after_listing=None, incremental=None):
         self.logger.debug('Scraping all listings...')
-        current_page = 1  # Page counter
+        current_page = checkpoint.page if checkpoint else 1  # Page counter
+        processed = checkpoint.processed if checkpoint else set()  # Listings done before a resume
         next_button = True  # Next button
 
         # Store which window is the index window
@@ -268,71 +387,136 @@ class Viewpoint(webdriver.Chrome):
         else:
             index_window = str(handle)
 
+        if incremental:
+            self.urls.start_crawl(incremental, resumed=processed)
+
         # Go through all of the properties on this page of this page of the index and scrape them
+        previous = None  # The links on the last page, so we can tell when the next one has loaded
         while bool(next_button):
             # Find all the different properties on the index page by matching the text on their buttons
-            listings = list()
+            # Wait for the links to change from the last page, to prevent duplicates
             retry = 0
-            button_strings = ['Entered', 'day on market', 'days on market']  # Find buttons with this text
-            self.explicitly_wait(3)  # Wait to prevent duplicates
-            for button_string in button_strings:
-                listings = listings + self.find_elements_by_partial_link_text(button_string)
+            with self.metrics.timer('index_links'):
+                listings = self.wait_for(index_loaded(previous), message='index links') or self.index_listings()
+            self.metrics.count('pages')
 
             # If there's no buttons found, it's probably a bug, reload the page and try again, up to 5 times
             while len(listings) == 0 and retry < 2:
                 retry += 1
+                self.metrics.count('index_retries')
                 self.logger.warning("No links found on page {p}".format(p=current_page))
-                self.explicitly_wait(60)
+                self.polite_pause()
                 self.refresh()
                 self.logger.debug("Refreshed page (retry #{n})".format(n=retry))
-                for button_string in button_strings:
-                    listings = listings + self.find_elements_by_partial_link_text(button_string)
-
-            self.logger.info('Found {n} links on page {p}'.format(n=len(listings),
-                                                                  p=current_page
-                                                                  ))
-            self.implicitly_wait(5)
+                listings = self.wait_for(index_loaded(), timeout=60, message='index links') or list()
+
+            previous = [href for _, href in listings]
+
+            # Decide whether this is the last page before anything on it is scraped
+            caught_up = False
+            if incremental:
+                if current_page == 1 and previous:
+                    self.urls.note_newest(incremental, previous[0])
+                caught_up = self.urls.caught_up(incremental, previous)
+
+            # Everything scraped so far is on disk before the checkpoint says we're on a new page
+            if checkpoint:
+                flush_all()
+                checkpoint.start_page(current_page, self.current_url)
+
+            # Only click on the listings we haven't seen yet, the rest would be opened just to be skipped
+            # A link only identifies a listing if no other button on the page shares it (e.g. 'href="#"')
+            # The checkpoint falls back to the listing's position on the page when it doesn't have a link
+            found = len(listings)
+            hrefs = Counter(href for _, href in listings)
+            listings = [(button, href if href and hrefs[href] == 1 else None) for button, href in listings]
+            listings = [(button, href, href or '{p}:{i}'.format(p=current_page, i=i))
+                        for i, (button, href) in enumerate(listings)]
+            listings = [(button, href, listing_id) for button, href, listing_id in listings
+                        if href not in self.worked and href not in self.failed and listing_id not in processed]
+            self.logger.info('Found {n} links on page {p}, {m} new'.format(n=found,
+                                                                          p=current_page,
+                                                                          m=len(listings)
+                                                                          ))
 
             # Click on each of the buttons and scrape the resulting data
-            for i, listing in enumerate(listings):
+            for i, (listing, href, listing_id) in enumerate(listings):
                 self.logger.debug('Starting property #{p} on page {page}'.format(p=i + 1, page=current_page))
-                self.implicitly_wait(2)
+                self.polite_pause()
+                listing_start = time.perf_counter()
                 # Try to open the window for each listing
                 try:
-                    window_opened = self.navigate_to_printable(listing)
+                    window_opened = self.navigate_to_printable(listing, href=href)
                 except sce.WebDriverException:
                     window_opened = False
+                    self.metrics.failure('webdriver_error')
                     self.logger.warning(
                         'Failed to open property #{p} on page {page}'.format(p=i + 1, page=current_page)
                     )
-                    self.implicitly_wait(4)
 
                 # If the window was successfully opened, read the listing
                 if window_opened:
-                    self.read_printable(out=self.out_path)
+                    if self.read_printable(out=self.out_path):
+                        for url in self.opened_urls:
+                            self.mark_worked(url)
                     self.close()
                     self.logger.debug('Finished with property #{p} on page {page}'.format(p=i + 1, page=current_page))
-                    self.implicitly_wait(5)
+                self.metrics.record('listing', time.perf_counter() - listing_start)
+                self.metrics.maybe_export()
 
                 # Switch back to the index to prepare for the next listing
                 self.switch_to.window(self.index_window)
                 self.logger.debug('Switched to index window ' + str(self.index_window))
-                self.implicitly_wait(2)
+                if checkpoint:
+                    checkpoint.done(listing_id)
+                if after_listing:
+                    after_listing(self)
 
             # Switch back to the index window
             # self.switch_to.window(index_window)
 
+            if caught_up:
+                self.logger.info('Caught up with the last crawl on page {p}, stopping'.format(p=current_page))
+                break
+
             # Check if there's a next button, and click on it if it exists
             next_button = self.next_button()
             if bool(next_button):
                 next_button.click()
                 current_page += 1
                 self.logger.debug('Switching to page {page}'.format(page=current_page))
-                self.implicitly_wait(5)
             else:  # If we're on the last page, print a message and stop
                 self.logger.info('All finished after page ' + str(current_page))
                 break
 
+    # Go back to the page of the index that 'checkpoint' was on
+    # The session should be on the first page of the index, e.g. from open_saved_search()
+    # If the checkpoint knows the page's URL it goes straight there, otherwise it clicks through the pages
+    def resume(self, checkpoint):
+        url = checkpoint.page_url(checkpoint.page)
+        if url:
+            self.logger.info('Resuming on page {p}: {url}'.format(p=checkpoint.page, url=url))
+            self.pace()
+            self.get(url)
+            self.index_window = self.current_window_handle
+            return checkpoint.page
+
+        self.logger.info('Resuming on page {p} by paging through the index'.format(p=checkpoint.page))
+        previous = None
+        page = 1
+        while page < checkpoint.page:
+            listings = self.wait_for(index_loaded(previous), message='index links') or self.index_listings()
+            previous = [href for _, href in listings]
+            next_button = self.next_button()
+            if not next_button:
+                self.logger.warning('Index ran out of pages before page {p}'.format(p=checkpoint.page))
+                break
+            self.pace()
+            next_button.click()
+            page += 1
+        checkpoint.page = page
+        return page
+
     # Check if there's a next button on this page
     # Return the button object if it exists, otherwise return false
     def next_button(self):
@@ -344,70 +528,258 @@ class Viewpoint(webdriver.Chrome):
         except sce.NoSuchElementException:
             out = False
             self.logger.debug('No next button detected. Must be done!')
-            self.implicitly_wait(2)
         return out
 
-    # If a URL doesn't work, record it to a log file and within the Viewpoint object
-    def record_failure(self, url, path=None):
-        if path is None:
-            path = self.fail_path
-        self.failed.append(url)
+    # Open the login URL and log in, then save the cookies so the next session can skip this
+    def login(self, username, password, login_url=LOGIN_URL):
+        self.logger.debug('Opening Viewpoint login URL: ' + str(login_url))
+        with self.metrics.timer('login'):
+            self.pace()
+            self.get(login_url)
+            self.wait_for(lambda driver: driver.find_elements_by_name('email'), timeout=30, message='login form')
+
+            # Fill in username and password and click on the button
+            self.logger.info('Logging in with username \'{0}\''.format(username))
+            self.find_element_by_name('email').send_keys(username)
+            self.find_element_by_name('password').send_keys(password)
+            self.find_element_by_class_name('big').click()
+            if not self.wait_for(logged_in, timeout=30, message='login'):
+                self.logger.warning('Couldn\'t tell if logging in worked, not saving the session')
+                return
+        self.metrics.count('logins')
+        self.sessions.save(username, self.current_url, self.get_cookies())
+        self.logger.debug('Successfully logged in')
+
+    # Load the cookies saved by an earlier login into the browser, and open the page that login landed on
+    # Returns True if that still shows us as logged in, or False if the form login is needed
+    def restore_session(self, username):
+        saved = self.sessions.load(username)
+        if saved is None:
+            return False
+        with self.metrics.timer('restore_session'):
+            try:
+                # Through DevTools, so the cookies can be set before anything on the site is loaded
+                self.execute_cdp_cmd('Network.setCookies', {'cookies': [cdp_cookie(c) for c in saved['cookies']]})
+            except sce.WebDriverException as e:
+                self.logger.warning('Couldn\'t restore the saved session: ' + str(e).strip())
+                return False
+            self.pace()
+            self.get(saved['url'])
+            state = self.wait_for(login_state, timeout=30, message='saved session')
+        if state != 'logged_in':
+            self.logger.info('Saved session has expired, logging in again')
+            self.sessions.clear()
+            self.delete_all_cookies()
+            return False
+        self.logger.info('Reusing the saved session for \'{0}\''.format(username))
+        self.metrics.count('sessions_reused')
+        return True
+
+    # If a URL doesn't work, record it to the retry queue (or a log file) and within the Viewpoint object
+    # 'reason' is a short name for what went wrong, it's counted in the metrics and decides when it's retried
+    def record_failure(self, url, path=None, reason='unknown'):
+        self.metrics.failure(reason)
+        self.urls.mark_failed(url)
         self.logger.warning('Recording failed url: ' + str(url))
-        with open(path, 'a') as file:
-            file.write(url + '\n')
+        if self.retries is not None and path is None:
+            self.retries.push(url, reason)
+        else:
+            append_line(path or self.fail_path, url + '\n')
 
     # This function takes a list of URLs and tries to scrape each one
     def scrape_urls(self, urls):
         urls = list(set(urls))  # Keep only the unique URLs
+        for url in urls:
+            with self.metrics.timer('listing'):
+                self.scrape_url(url)
+            self.metrics.maybe_export()
+
+    # Scrape a single URL, either a printable cutsheet or a 'pretty' listing page
+    # Returns True if the listing was read, otherwise False
+    def scrape_url(self, url):
+        if url in self.failed:
+            self.logger.info('Already failed: ' + url)
+            return False
+        if url in self.worked:
+            self.logger.info('Already scraped: ' + url)
+            return False
 
         # Printable pages are scraped using the vp.read() function
         # This is the trivial case of simply re-trying
-        for url in urls:
-            if url in self.failed:
-                self.logger.info('Already failed:', url)
-                continue
-            if 'cutsheet' in url:
-                self.get(url)
-                self.explicitly_wait(2)
-                self.read_printable(self.out_path)
+        if 'cutsheet' in url:
+            # Cutsheets don't need a browser, so fetch them directly if possible
+            if self.fetcher is not None:
+                self.pace()
+                with self.metrics.timer('fetch'):
+                    html = self.fetch_cutsheet(url)
+                if html is not None:
+                    return self.mark_if_read(url, self.read_html(html, url, out=self.out_path))
+                self.logger.info('Direct fetch failed, falling back to the browser for ' + url)
+            self.polite_pause()
+            self.pace()
+            self.get(url)
+            self.wait_for(cutsheet_loaded, message='cutsheet')
+            return self.mark_if_read(url, self.read_printable(self.out_path))
 
         # If the URL is the path to a 'pretty' listing page, we need to switch to the printable version first
         # This adds a lot more steps
-            elif 'property' in url:
-                self.get(url)
-                self.explicitly_wait(2)
-                main_window = self.current_window_handle
-                # --- Switch to the printable window
-                # Try to click on the print button
-                try:
-                    self.find_element_by_class_name('cutsheet-print').click()
-                    self.logger.debug('Clicked on print button')
-                    self.implicitly_wait(2)
-                except sce.NoSuchElementException:
-                    self.logger.warning('No print button! Skipping ' + self.current_url)
-                    self.implicitly_wait(5)
-                    self.record_failure(self.current_url)
-                    continue
-
-                # Switch context to the printable page
-                try:
-                    new_window = list({x for x in self.window_handles} - {main_window})[0]
-                    self.logger.debug("Windows open:", self.window_handles)
-                    self.switch_to.window(new_window)
-                    self.logger.debug('Switched focus to printable window')
-                    self.implicitly_wait(5)
-                except (IndexError, sce.WebDriverException):
-                    self.logger.warning('Couldn\'t open window. Skipping ' + self.current_url)
-                    self.implicitly_wait(5)
-                    self.record_failure(self.current_url)
-                    continue
-
-                # --- End of switching to printable window
-                self.read_printable(self.out_path)
-                self.switch_to.window(main_window)
-                self.close()
-            else:
-                self.logger.warning('Don\'t know how to handle:' + url)
+        elif 'property' in url:
+            self.polite_pause()
+            self.pace()
+            self.get(url)
+            self.wait_for(print_button, message='print button')
+            self.record_page_weight()
+            main_window = self.current_window_handle
+            # Other windows may be open too, e.g. the index when retrying in between listings
+            before = set(self.window_handles)
+            # --- Switch to the printable window
+            # Try to click on the print button
+            try:
+                self.find_element_by_class_name('cutsheet-print').click()
+                self.logger.debug('Clicked on print button')
+                self.wait_for(window_count_changed(len(before)), message='print window')
+            except sce.NoSuchElementException:
+                self.logger.warning('No print button! Skipping ' + self.current_url)
+                self.record_failure(self.current_url, reason='no_print_button')
+                return False
+
+            # Switch context to the printable page
+            try:
+                new_window = list({x for x in self.window_handles} - before)[0]
+                self.logger.debug('Windows open: ' + str(self.window_handles))
+                self.switch_to.window(new_window)
+                self.wait_for(cutsheet_loaded, message='cutsheet')
+                self.logger.debug('Switched focus to printable window')
+            except (IndexError, sce.WebDriverException):
+                self.logger.warning('Couldn\'t open window. Skipping ' + self.current_url)
+                self.record_failure(self.current_url, reason='window_not_opened')
+                return False
+
+            # --- End of switching to printable window
+            # Close the printable window once it's read, so the session is left on the main window
+            worked = self.read_printable(self.out_path)
+            self.close()
+            self.switch_to.window(main_window)
+            return self.mark_if_read(url, worked)
+        else:
+            self.logger.warning('Don\'t know how to handle: ' + url)
+            return False
+
+    # Remember 'url' as scraped if reading it worked, and pass along whether it did
+    def mark_if_read(self, url, worked):
+        if worked:
+            self.mark_worked(url)
+            if self.retries is not None:
+                self.retries.done(url)
+        return bool(worked)
+
+    # Remember 'url' as scraped. It's skipped from now on, but it's only saved as worked in the URL store
+    # once the records written so far are on disk (see RecordWriter.after_flush), so a crash can't lose
+    # a listing that was already marked as done
+    def mark_worked(self, url):
+        self.failed.discard(url)
+        self.worked.add(url)
+        RecordWriter.open(self.out_path).after_flush(lambda: self._save_worked(url))
+
+    def _save_worked(self, url):
+        # Unless it's failed again in the meantime
+        if url not in self.failed:
+            self.urls.mark_worked(url)
+
+    # Fetch a cutsheet over HTTP, without the browser. Returns the HTML, or None if it couldn't be fetched
+    # If the login cookies have gone stale, copy them from the browser again and retry once
+    def fetch_cutsheet(self, url):
+        html = self.fetcher.get(url)
+        if html is False:
+            self.logger.debug('Direct fetch was sent to the login page, refreshing cookies')
+            self.fetcher.update_cookies(self.get_cookies())
+            html = self.fetcher.get(url)
+        return html or None
+
+    # Finds the listing links on the current index page by the text on their buttons
+    # Returns a list of (element, href) pairs, pulled out of the page in a single call to the browser
+    # instead of a round trip for every element
+    def index_listings(self, button_strings=('Entered', 'day on market', 'days on market')):
+        script = '''
+            var strings = arguments[0];
+            var out = [];
+            document.querySelectorAll('a').forEach(function (a) {
+                var text = a.textContent;
+                for (var i = 0; i < strings.length; i++) {
+                    if (text.indexOf(strings[i]) !== -1) {
+                        out.push([a, a.href]);
+                        break;
+                    }
+                }
+            });
+            return out;
+        '''
+        return [(button, href) for button, href in self.execute_script(script, list(button_strings))]
+
+    # Returns the URLs behind each of the listing links on the current index page
+    # Used when the listings are handed to other sessions, which can't click on this session's elements
+    def listing_urls(self, listings=None):
+        if listings is None:
+            listings = self.index_listings()
+        urls = list()
+        for _, href in listings:
+            if href and href not in urls:
+                urls.append(href)
+        return urls
+
+    # Open one of the saved searches from the dashboard, leaving the session focused on its index
+    def open_saved_search(self, name):
+        # Open the Dashboard for a text list
+        self.logger.debug('Opening the dashboard')
+        self.click_link(partial_link('DASHBOARD'), 'dashboard link')
+
+        # Click on the 'Saved Searches' link
+        self.logger.debug('Opening saved searches')
+        self.click_link(partial_link('SAVED SEARCHES'), 'saved searches link')
+
+        # Open the saved search by (part of) its name
+        self.logger.debug('Opening saved search \'{0}\''.format(name))
+        self.click_link(partial_link(name), 'saved search')
+        self.index_window = self.current_window_handle
+
+    # Wait for the link that 'condition' finds, then click on it
+    def click_link(self, condition, message='link', timeout=30):
+        links = self.wait_for(condition, timeout=timeout, message=message)
+        if not links:
+            raise sce.NoSuchElementException('No ' + message + ' found on ' + self.current_url)
+        self.polite_pause()
+        self.pace()
+        links[0].click()
+
+    # Make sure everything that was scraped is on disk before the browser goes away
+    def quit(self):
+        flush_all()
+        if self.ingest is not None:
+            self.ingest.flush()
+        if self.archive is not None:
+            self.archive.flush()
+        self.metrics.export()
+        super().quit()
+
+    # Count how many bytes the focused page came to and how long it took to load, see _PAGE_WEIGHT
+    def record_page_weight(self):
+        try:
+            weight = self.execute_script(_PAGE_WEIGHT)
+        except sce.WebDriverException:
+            return
+        if not weight:
+            return
+        size, resources, load_ms = weight
+        self.metrics.count('pages_weighed')
+        self.metrics.count('page_bytes', int(size))
+        self.metrics.count('page_resources', int(resources))
+        if load_ms and load_ms > 0:
+            self.metrics.record('page_load', load_ms / 1000)
+
+    # Block until the shared rate limiter (if there is one) allows another request
+    def pace(self):
+        if self.throttle is not None:
+            self.throttle.wait()
 
     # Implicitly wait a normally distributed amount of time above 'min_'
     def implicitly_wait_rand(self, min_):
@@ -417,6 +789,28 @@ class Viewpoint(webdriver.Chrome):
         self.implicitly_wait(wt)
         return None
 
+    # Wait until 'condition' returns something truthy, checking every 'poll' seconds for up to 'timeout' seconds
+    # 'condition' is called with the driver, see the conditions at the bottom of this file
+    # Returns whatever the condition returned, or False if it timed out
+    def wait_for(self, condition, timeout=10, poll=0.2, message='condition'):
+        with self.metrics.timer('wait: ' + message):
+            try:
+                return WebDriverWait(self, timeout, poll_frequency=poll).until(condition)
+            except sce.TimeoutException:
+                self.logger.debug('Gave up waiting for {m} after {t} secs'.format(m=message, t=timeout))
+                self.metrics.count('wait_timeouts')
+                return False
+
+    # Wait the politeness floor plus a normally distributed amount of jitter
+    # This is the only unconditional sleep left for each listing
+    def polite_pause(self):
+        wt = self.politeness
+        if self.jitter:
+            wt += abs(rand_norm(loc=0, scale=self.jitter))
+        self.logger.debug('Politely waiting {0:.1f} secs'.format(wt))
+        self.metrics.record('politeness', wt)
+        time.sleep(wt)
+
     # Explicitly wait a normally distributed amount of time above 'shortest'
     def explicitly_wait(self, shortest):
         st_dev = 2
@@ -437,24 +831,69 @@ class Viewpoint(webdriver.Chrome):
             self.current_window_handle,
             window_dict.setdefault(self.current_window_handle, "unknown"),
             self.current_url))
-        self.implicitly_wait(2)
         self.switch_to.window(start_window)
         self.logger.debug('Done of window logging, switching back to {0}'.format(start_window))
 
     # Closes every window except the index window (with the handle self.index_window)
-    def close_leftover_windows(self):
+    # and 'keep', if it's given, then focuses 'keep' (or the index window)
+    def close_leftover_windows(self, keep=None):
         if len(self.window_handles) == 1:
             return
         self.logger.debug('Open windows before cleanup: {}'.format(len(self.window_handles)))
         self.logger.debug('Closing leftover windows...')
         for window in self.window_handles:
-            if window != self.index_window:
+            if window not in (self.index_window, keep):
                 self.switch_to.window(window)
                 self.close()
-        self.switch_to.window(self.index_window)
+        self.switch_to.window(keep or self.index_window)
         self.logger.debug('Open windows after cleanup: {}'.format(len(self.window_handles)))
 
 
+# Conditions for Viewpoint.wait_for(), each is called with the driver and is truthy once it's satisfied
+# The number of open windows is different from 'count'
+def window_count_changed(count):
+    return lambda driver: len(driver.window_handles) != count
+
+
+# There's a window open besides 'handle'
+def window_other_than(handle):
+    return lambda driver: [window for window in driver.window_handles if window != handle]
+
+
+# The session is past the login form, and the dashboard link is showing
+def logged_in(driver):
+    return not driver.find_elements_by_name('password') and driver.find_elements_by_partial_link_text('DASHBOARD')
+
+
+# 'logged_out' if the page is the login form, 'logged_in' if it's past it, otherwise it's still loading
+def login_state(driver):
+    if driver.find_elements_by_name('password'):
+        return 'logged_out'
+    if driver.find_elements_by_partial_link_text('DASHBOARD'):
+        return 'logged_in'
+    return False
+
+
+# The page has a link with 'text' in it
+def partial_link(text):
+    return lambda driver: driver.find_elements_by_partial_link_text(text)
+
+
+# The page has a print button
+def print_button(driver):
+    return driver.find_elements_by_class_name('cutsheet-print')
+
 
+# The focused window is a cutsheet with its address in the title and the data table rendered
+def cutsheet_loaded(driver):
+    return len(driver.title) > 10 and driver.find_elements_by_css_selector('li.row')
 
 
+# The index has listing links, and they aren't the same links as 'previous' (the last page)
+def index_loaded(previous=None):
+    def condition(driver):
+        listings = driver.index_listings()
+        if listings and [href for _, href in listings] != previous:
+            return listings
+        return False
+    return condition
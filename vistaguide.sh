@@ -25,6 +25,12 @@ Rscript --no-save --no-restore --verbose 03-cleanup-scraped.R
 
 # No need to run 04, it's run from 03
 
+# Geocode the new properties, anything looked up before comes from the cache
+venv/bin/python3 -u geocode.py
+
+# Fold the new updates into the aggregate tables the report reads
+venv/bin/python3 -u aggregates.py
+
 # Render the markdown file
 Rscript --no-save --no-restore --verbose 05-render-markdown.R
 
@@ -0,0 +1,103 @@
+import atexit
+from datetime import datetime
+import json
+import os
+import threading
+import time
+
+# Every record written has exactly these keys, in this order
+# 'fields' is the list of 'li.row' fields from the cutsheet, see cutsheet.Cutsheet
+SCHEMA = ['datetime', 'title', 'url', 'description', 'fields']
+
+# One writer per output path, so sessions in a pool share a buffer (see RecordWriter.open)
+_writers = dict()
+_writers_lock = threading.Lock()
+
+
+'''
+Writes scraped listings as newline-delimited JSON, one record per line
+Records are buffered and written out every 'flush_every' records or 'flush_secs' seconds,
+whichever comes first. Each flush writes whole lines and fsyncs, so a crash loses at most the
+unflushed buffer and never leaves half a row behind
+Anything that has to wait until the records are on disk, like marking their URLs as worked, goes
+through after_flush(), so a crash can't leave a listing marked as done that never made it to the file
+'''
+class RecordWriter:
+    def __init__(self, path, flush_every=25, flush_secs=30):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_secs = flush_secs
+        self._buffer = list()
+        self._pending = list()  # after_flush() callbacks waiting for the buffer to be written
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    # Get the shared writer for 'path', creating it the first time
+    @classmethod
+    def open(cls, path, **kwargs):
+        with _writers_lock:
+            if path not in _writers:
+                _writers[path] = cls(path, **kwargs)
+            return _writers[path]
+
+    # Buffer a record (a dict with the keys in SCHEMA), flushing if it's time
+    def write(self, record):
+        line = json.dumps({key: record.get(key) for key in SCHEMA}, ensure_ascii=False)
+        with self._lock:
+            self._buffer.append(line + '\n')
+            due = (len(self._buffer) >= self.flush_every or
+                   time.monotonic() - self._last_flush >= self.flush_secs)
+            callbacks = self._flush() if due else []
+        _run(callbacks)
+
+    # Call 'callback' once everything written so far is on disk, right away if nothing's buffered
+    def after_flush(self, callback):
+        with self._lock:
+            if self._buffer:
+                self._pending.append(callback)
+                return
+        callback()
+
+    def flush(self):
+        with self._lock:
+            callbacks = self._flush()
+        _run(callbacks)
+
+    # Write out the buffer, returns the after_flush() callbacks that can run now
+    # They're run by the caller once the lock is released, since they usually take other locks
+    def _flush(self):
+        self._last_flush = time.monotonic()
+        if self._buffer:
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(''.join(self._buffer))
+                file.flush()
+                os.fsync(file.fileno())
+            self._buffer = list()
+        callbacks, self._pending = self._pending, list()
+        return callbacks
+
+
+def _run(callbacks):
+    for callback in callbacks:
+        callback()
+
+
+# Finds the next unused filename with the format baseYYYMMDDI.ext
+# e.g., listing-202004051.jsonl for the second output of April 5, 2020
+# Older outputs were .csv, so those count as used too
+def next_filename(base: chr = 'listing_', ext: chr = 'jsonl') -> chr:
+    i = 0
+    dt = datetime.now().strftime('%Y%m%d')
+    while any(os.path.exists('{base}{dt}{i}.{ext}'.format(base=base, dt=dt, i=i, ext=x))
+              for x in (ext, 'csv', 'done')):
+        i += 1
+    return '{base}{dt}{i}.{ext}'.format(base=base, dt=dt, i=i, ext=ext)
+
+
+# Flush every open writer, this also runs when the interpreter exits
+@atexit.register
+def flush_all():
+    with _writers_lock:
+        writers = list(_writers.values())
+    for writer in writers:
+        writer.flush()